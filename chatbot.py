@@ -4,27 +4,85 @@ import pandas as pd
 from datetime import datetime, date
 import os
 from typing import Optional, Tuple, List, Dict, Any
-import json
 import io
+import re
+import functools
+import hashlib
+import tempfile
+from collections import deque, OrderedDict
 from dotenv import load_dotenv
-from langchain_core.chat_history import InMemoryChatMessageHistory
-from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
-from transformers import pipeline, Pipeline, AutoTokenizer, AutoModelForSequenceClassification
+from langchain_core.output_parsers import PydanticOutputParser
+from pydantic import BaseModel, Field
+from transformers import pipeline, Pipeline, AutoTokenizer, AutoModel, AutoModelForSequenceClassification
 import torch
 
 
-
-# Load environment variables
-load_dotenv()
-
 # Import agentic AI utilities
-from scripts.utils import TransactionQueryAgent
+from scripts.database_creation import BANK_ACCOUNT_PAIRS_SQL
+from scripts.utils import TransactionQueryAgent, BoundedChatMessageHistory, get_from_cache, set_cache, get_llm
 
 
 # Database path
 DB_PATH = "database/transactions.db"
 
+# Number of most recent messages rendered before "Show older messages" is clicked
+HISTORY_RENDER_WINDOW = 20
+
+# Per-session memory bounds
+EXECUTION_LOG_MAX_ENTRIES = 200
+LLM_CHAT_HISTORY_MAX_MESSAGES = 20
+CONVERSATION_HISTORY_MAX_ENTRIES = 100
+
+# Rows of a CSV answer shown as the table preview (the download has all rows)
+CSV_PREVIEW_ROWS = 100
+
+# Escapes "$" so Streamlit markdown does not treat amounts as LaTeX
+_DOLLAR_ESCAPE = str.maketrans({"$": "\\$"})
+
+# Example questions offered before the first message
+EXAMPLE_QUESTIONS = (
+    "How much did I spend last week?",
+    "What is the amount I have spent on Uber in the last 5 months?",
+    "How much money did I receive from amazon last month?",
+)
+
+# Recent LLM chat-history messages that follow-up answers depend on (the SQL prompt's window);
+# their digest is part of the answer cache key
+ANSWER_CACHE_HISTORY_MESSAGES = 10
+
+# Function words ignored when matching re-asked questions against the answer cache
+QUESTION_STOPWORDS = frozenset({
+    "a", "an", "the", "please", "i", "me", "my", "is", "are", "was", "were", "do", "did", "of"
+})
+
+# Semantic answer cache: re-phrased questions whose embeddings are this similar (cosine)
+# reuse the cached answer, provided they agree on the words that change the figures:
+# numbers, time periods, money direction and merchant/category names
+SEMANTIC_CACHE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_PERIOD_WORDS = frozenset({
+    "today", "yesterday", "day", "days", "week", "weeks", "weekend", "month", "months",
+    "quarter", "year", "years", "ytd", "last", "this", "previous", "past", "current",
+    "january", "february", "march", "april", "may", "june", "july", "august",
+    "september", "october", "november", "december",
+    "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec"
+})
+# Spend/receive words, mapped to the direction they ask about
+SEMANTIC_CACHE_DIRECTION_WORDS = {
+    "spend": "debit", "spent": "debit", "spending": "debit", "pay": "debit", "paid": "debit",
+    "debit": "debit", "debits": "debit", "expenses": "debit",
+    "receive": "credit", "received": "credit", "earn": "credit", "earned": "credit",
+    "income": "credit", "credit": "credit", "credits": "credit", "deposits": "credit"
+}
+# Question words never treated as merchant/category names (some merchant names contain them)
+SEMANTIC_CACHE_FILLER_WORDS = frozenset({
+    "what", "whats", "how", "show", "tell", "give", "list", "can", "could", "would", "you",
+    "us", "know", "let", "see", "find", "get", "have", "has", "been", "to", "in", "on", "at", "for",
+    "from", "by", "up", "per", "all", "total", "money", "amount", "transaction", "transactions",
+    "merchant", "merchants", "category", "categories"
+})
+
 # Page configuration
 st.set_page_config(
     page_title="Transaction Query Assistant (Agentic AI)",
@@ -32,21 +90,41 @@ st.set_page_config(
     layout="wide"
 )
 
+
+@st.cache_resource(show_spinner=False)
+def _init_env() -> bool:
+    """Load environment variables from .env once per server process, not on every rerun."""
+    load_dotenv()
+    return True
+
+
+# Load environment variables
+_init_env()
+
 # Initialize session state
 if 'conversation_history' not in st.session_state:
     st.session_state.conversation_history = []
 if 'agent_memory' not in st.session_state:
     st.session_state.agent_memory = []
 if 'execution_log' not in st.session_state:
-    st.session_state.execution_log = []
+    st.session_state.execution_log = deque(maxlen=EXECUTION_LOG_MAX_ENTRIES)
 if 'llm_chat_history' not in st.session_state:
-    st.session_state.llm_chat_history = InMemoryChatMessageHistory()
+    st.session_state.llm_chat_history = BoundedChatMessageHistory(max_messages=LLM_CHAT_HISTORY_MAX_MESSAGES)
 if 'sql_cache' not in st.session_state:
-    st.session_state.sql_cache = {}
+    st.session_state.sql_cache = OrderedDict()
 if 'query_result_cache' not in st.session_state:
-    st.session_state.query_result_cache = {}
+    st.session_state.query_result_cache = OrderedDict()
 if 'analysis_cache' not in st.session_state:
-    st.session_state.analysis_cache = {}
+    st.session_state.analysis_cache = OrderedDict()
+if 'answer_cache' not in st.session_state:
+    st.session_state.answer_cache = OrderedDict()
+    st.session_state.answer_cache_data_version = None
+if 'answer_embeddings' not in st.session_state:
+    st.session_state.answer_embeddings = {}
+if 'validation_cache' not in st.session_state:
+    st.session_state.validation_cache = OrderedDict()
+if 'calculation_cache' not in st.session_state:
+    st.session_state.calculation_cache = OrderedDict()
 if 'injection_classifier' not in st.session_state:
     # Load the prompt injection detection model once at startup
     # Model: protectai/deberta-v3-base-prompt-injection
@@ -68,61 +146,279 @@ if 'injection_classifier' not in st.session_state:
     st.session_state.injection_classifier = classifier
 
 
+@st.cache_resource
 def get_db_connection():
-    """Create and return a database connection."""
+    """Create and return the shared database connection (one per server process)."""
     if not os.path.exists(DB_PATH):
         raise FileNotFoundError(f"Database not found at {DB_PATH}. Please ensure the database exists.")
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")    # 64 MiB page cache
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB mmap
+    # Covering index so the sidebar DISTINCT lookups are index-only scans
+    try:
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tx_bankacct ON transactions(bank_id, account_id)")
+    except sqlite3.Error:
+        # Read-only deployments simply fall back to a table scan
+        pass
+    return conn
+
 
+@st.cache_resource
+def get_query_connection():
+    """
+    Create and return the shared connection used for agent-generated SQL.
+    
+    query_only makes SQLite itself reject any write, backing up the
+    keyword filter in validate_sql_query.
+    """
+    # Open the main connection first so the database exists and is in WAL mode
+    get_db_connection()
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA query_only=ON")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")    # 64 MiB page cache
+    conn.execute("PRAGMA mmap_size=268435456")  # 256 MiB mmap
+    return conn
 
+
+@st.cache_resource(show_spinner=False)
+def get_id_lookup_table() -> str:
+    """
+    Materialize distinct (bank_id, account_id) pairs once and return the table to query for IDs.
+    
+    Returns "bank_account_pairs" when the helper table is available, otherwise
+    "transactions" (e.g. on a read-only database).
+    """
+    conn = get_db_connection()
+    try:
+        conn.executescript(BANK_ACCOUNT_PAIRS_SQL)
+        return "bank_account_pairs"
+    except sqlite3.Error:
+        return "transactions"
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
 def get_table_schema() -> str:
-    """Get the schema of the transactions table."""
+    """Get the schema of the transactions table (cached across reruns)."""
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("PRAGMA table_info(transactions)")
+    # table_xinfo (unlike table_info) includes generated columns such as transaction_type
+    cursor.execute("PRAGMA table_xinfo(transactions)")
     columns = cursor.fetchall()
-    conn.close()
+    
+    # Add sample data for context
+    sample = pd.read_sql_query("SELECT * FROM transactions LIMIT 3", conn)
     
     schema = "Table: transactions\n"
     schema += "Columns:\n"
     for col in columns:
         schema += f"  - {col[1]} ({col[2]})\n"
     
-    # Add sample data for context
-    conn = get_db_connection()
-    sample = pd.read_sql_query("SELECT * FROM transactions LIMIT 3", conn)
-    conn.close()
-    
     schema += "\nSample data:\n"
     schema += sample.to_string()
     
     return schema
 
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_unique_bank_ids() -> List[int]:
-    """Get unique bank_id values from the database."""
-    try:
-        conn = get_db_connection()
-        df = pd.read_sql_query("SELECT DISTINCT bank_id FROM transactions ORDER BY bank_id", conn)
-        conn.close()
-        return sorted(df['bank_id'].tolist())
-    except Exception as e:
-        return []
+    """Get unique bank_id values from the database (errors propagate and are not cached)."""
+    conn = get_db_connection()
+    lookup_table = get_id_lookup_table()
+    return [row[0] for row in conn.execute(f"SELECT DISTINCT bank_id FROM {lookup_table} ORDER BY bank_id")]
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _get_account_ids_cached(bank_ids: Tuple[int, ...]) -> List[int]:
+    """Cached lookup of account_id values for a normalized tuple of bank_ids."""
+    conn = get_db_connection()
+    lookup_table = get_id_lookup_table()
+    placeholders = ",".join("?" * len(bank_ids))
+    cursor = conn.execute(
+        f"SELECT DISTINCT account_id FROM {lookup_table} WHERE bank_id IN ({placeholders}) ORDER BY account_id",
+        bank_ids
+    )
+    return [row[0] for row in cursor]
 
 
 def get_account_ids_by_bank_ids(bank_ids: List[int]) -> List[int]:
     """Get unique account_id values filtered by bank_ids."""
     if not bank_ids:
         return []
+    # Sort and dedupe so the same selection in any order hits the same cache entry
+    return _get_account_ids_cached(tuple(sorted(set(bank_ids))))
+
+
+class SpellingCorrection(BaseModel):
+    """A single misspelled word and its correction."""
+    original: str = ""
+    corrected: str = ""
+
+
+class SpellCheckResult(BaseModel):
+    """Structured output of the spelling-check LLM call."""
+    has_errors: bool = False
+    corrected_question: str = ""
+    corrections: List[SpellingCorrection] = Field(default_factory=list)
+
+
+# Parses (possibly fenced) JSON output straight into a SpellCheckResult
+_SPELLCHECK_PARSER = PydanticOutputParser(pydantic_object=SpellCheckResult)
+
+# Spelling-check prompt is built once at import instead of on every call
+_SPELLCHECK_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a spelling and grammar checker. Analyze the user's question and identify spelling errors. Return a JSON response with corrected text and individual corrections."),
+    ("human", """Check the spelling in the following question and provide corrections if needed.
+
+    Original Question: {question}
+
+    Instructions:
+    - Check for spelling errors in the question
+    - If there are NO spelling errors, return the original question unchanged
+    - If there ARE spelling errors, provide the corrected question and list the corrections
+    - Focus only on spelling, not grammar or meaning changes
+    - Preserve the original structure and capitalization
+
+    Return your response in the following JSON format:
+    {{
+        "has_errors": true/false,
+        "corrected_question": "corrected version of the question",
+        "corrections": [
+            {{"original": "misspeled", "corrected": "misspelled"}},
+            {{"original": "recieve", "corrected": "receive"}}
+        ]
+    }}
+
+    If there are no spelling errors, set "has_errors" to false and return the original question in "corrected_question" with an empty "corrections" array.
+
+    JSON Response:""")
+])
+
+
+@functools.lru_cache(maxsize=512)
+def _spellcheck_cached(question: str, api_key: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Run the LLM spelling check for a question, memoized per (question, api_key).
+    
+    Raises on LLM or JSON errors so that failures are never cached.
+    """
+    # The parser strips markdown fences and validates the JSON
+    # (a parse error propagates so the failure is not cached)
+    chain = _SPELLCHECK_PROMPT | get_llm(api_key) | _SPELLCHECK_PARSER
+    result = chain.invoke({"question": question})
+    
+    corrected_question = result.corrected_question or question
+    
+    # Format suggestions list
+    suggestions = []
+    if result.has_errors:
+        suggestions = [
+            f"'{correction.original}' → '{correction.corrected}'"
+            for correction in result.corrections
+            if correction.original and correction.corrected
+        ]
+    
+    return corrected_question, tuple(suggestions)
+
+
+def normalize_question(question: str) -> str:
+    """Canonicalize a question so trivially re-phrased re-asks share an answer cache key."""
+    # Token order is kept: "top 3 ... last 5 months" and "top 5 ... last 3 months" differ
+    tokens = re.sub(r"[^\w\s]", " ", question.lower()).split()
+    return " ".join(token for token in tokens if token not in QUESTION_STOPWORDS)
+
+
+def history_digest(history: BoundedChatMessageHistory) -> str:
+    """Digest of the recent chat history, so follow-ups are only answered from the same context."""
+    digest = hashlib.blake2b(digest_size=16)
+    for message in history.messages[-ANSWER_CACHE_HISTORY_MESSAGES:]:
+        digest.update(f"{message.type}\0{message.content}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+
+@st.cache_resource(show_spinner=False)
+def get_embedding_model() -> Optional[Tuple[Any, Any]]:
+    """Load the sentence-embedding model for the semantic answer cache (None if unavailable)."""
     try:
-        conn = get_db_connection()
-        bank_ids_str = ','.join(map(str, bank_ids))
-        query = f"SELECT DISTINCT account_id FROM transactions WHERE bank_id IN ({bank_ids_str}) ORDER BY account_id"
-        df = pd.read_sql_query(query, conn)
-        conn.close()
-        return sorted(df['account_id'].tolist())
+        tokenizer = AutoTokenizer.from_pretrained(SEMANTIC_CACHE_MODEL)
+        model = AutoModel.from_pretrained(SEMANTIC_CACHE_MODEL)
+        model.eval()
+        return tokenizer, model
+    except Exception:
+        # Without the model only exact (normalized) re-asks hit the answer cache
+        return None
+
+
+def embed_question(question: str) -> Optional[torch.Tensor]:
+    """Return the L2-normalized mean-pooled embedding of a question, or None if unavailable."""
+    embedding_model = get_embedding_model()
+    if embedding_model is None:
+        return None
+    tokenizer, model = embedding_model
+    with torch.inference_mode():
+        inputs = tokenizer(question, return_tensors="pt", truncation=True, max_length=128)
+        token_embeddings = model(**inputs).last_hidden_state[0]
+        mask = inputs["attention_mask"][0].unsqueeze(-1).to(token_embeddings.dtype)
+        embedding = (token_embeddings * mask).sum(dim=0) / mask.sum()
+        return torch.nn.functional.normalize(embedding, dim=0)
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_name_vocabulary() -> frozenset:
+    """Lower-cased words of merchant and category names, used by the semantic cache guard."""
+    conn = get_db_connection()
+    words = set()
+    for (name,) in conn.execute("SELECT DISTINCT merchant FROM transactions UNION SELECT DISTINCT category FROM transactions"):
+        if name:
+            words.update(re.sub(r"[^\w\s]", " ", name.lower()).split())
+    return frozenset(words - QUESTION_STOPWORDS - SEMANTIC_CACHE_FILLER_WORDS - SEMANTIC_CACHE_DIRECTION_WORDS.keys())
+
+
+def question_guard_tokens(question: str) -> frozenset:
+    """Numbers, periods, direction and merchant/category words that must match for a semantic cache hit."""
+    tokens = re.sub(r"[^\w\s]", " ", question.lower()).split()
+    names = get_name_vocabulary()
+    return frozenset(
+        SEMANTIC_CACHE_DIRECTION_WORDS.get(token, token)
+        for token in tokens
+        if token.isdigit() or token in SEMANTIC_CACHE_PERIOD_WORDS
+        or token in SEMANTIC_CACHE_DIRECTION_WORDS or token in names
+    )
+
+
+def find_semantic_answer(answer_cache_key: Tuple, question: str, embedding: torch.Tensor) -> Optional[Dict[str, Any]]:
+    """
+    Look up a cached answer for a re-phrased question.
+    
+    Only entries with the same bank/account/date scope, chat-history digest and guard tokens are
+    compared; the best match is returned if its cosine similarity clears the threshold.
+    """
+    guard = question_guard_tokens(question)
+    candidates = [
+        (key, cached_embedding)
+        for key, (cached_embedding, cached_guard) in st.session_state.answer_embeddings.items()
+        if key[1:] == answer_cache_key[1:] and cached_guard == guard and key in st.session_state.answer_cache
+    ]
+    if not candidates:
+        return None
+    
+    # One matrix-vector product scores every candidate
+    similarities = torch.stack([cached_embedding for _, cached_embedding in candidates]) @ embedding
+    best = int(similarities.argmax())
+    if similarities[best].item() < SEMANTIC_CACHE_THRESHOLD:
+        return None
+    return get_from_cache(candidates[best][0], st.session_state.answer_cache)
+
+
+def get_data_version() -> Optional[int]:
+    """Return SQLite's data_version counter, which changes whenever the database is modified."""
+    try:
+        return get_db_connection().execute("PRAGMA data_version").fetchone()[0]
     except Exception as e:
-        return []
+        return None
 
 
 def check_spelling(question: str, api_key: Optional[str] = None) -> Tuple[str, List[str]]:
@@ -146,77 +442,10 @@ def check_spelling(question: str, api_key: Optional[str] = None) -> Tuple[str, L
         return question, []
     
     try:
-        llm = ChatGroq(
-            groq_api_key=api_key,
-            model_name="llama-3.3-70b-versatile",
-            temperature=0.1
-        )
-        
-        prompt_template = ChatPromptTemplate.from_messages([
-            ("system", "You are a spelling and grammar checker. Analyze the user's question and identify spelling errors. Return a JSON response with corrected text and individual corrections."),
-            ("human", """Check the spelling in the following question and provide corrections if needed.
-
-            Original Question: {question}
-
-            Instructions:
-            - Check for spelling errors in the question
-            - If there are NO spelling errors, return the original question unchanged
-            - If there ARE spelling errors, provide the corrected question and list the corrections
-            - Focus only on spelling, not grammar or meaning changes
-            - Preserve the original structure and capitalization
-
-            Return your response in the following JSON format:
-            {{
-                "has_errors": true/false,
-                "corrected_question": "corrected version of the question",
-                "corrections": [
-                    {{"original": "misspeled", "corrected": "misspelled"}},
-                    {{"original": "recieve", "corrected": "receive"}}
-                ]
-            }}
-
-            If there are no spelling errors, set "has_errors" to false and return the original question in "corrected_question" with an empty "corrections" array.
-
-            JSON Response:""")
-        ])
-        
-        chain = prompt_template | llm
-        response = chain.invoke({"question": question})
-        
-        # Parse JSON response
-        try:
-            result_text = response.content.strip()
-            # Remove markdown code blocks if present
-            if result_text.startswith("```json"):
-                result_text = result_text[7:]
-            elif result_text.startswith("```"):
-                result_text = result_text[3:]
-            if result_text.endswith("```"):
-                result_text = result_text[:-3]
-            result_text = result_text.strip()
-            
-            result = json.loads(result_text)
-            
-            corrected_question = result.get("corrected_question", question)
-            corrections = result.get("corrections", [])
-            
-            # Format suggestions list
-            suggestions = []
-            if result.get("has_errors", False) and corrections:
-                for correction in corrections:
-                    original = correction.get("original", "")
-                    corrected = correction.get("corrected", "")
-                    if original and corrected:
-                        suggestions.append(f"'{original}' → '{corrected}'")
-            
-            return corrected_question, suggestions
-            
-        except (json.JSONDecodeError, KeyError) as e:
-            # If JSON parsing fails, return original question
-            return question, []
-            
+        corrected_question, suggestions = _spellcheck_cached(question, api_key)
+        return corrected_question, list(suggestions)
     except Exception as e:
-        # If LLM call fails, return original question
+        # If LLM call or JSON parsing fails, return original question
         return question, []
 
 
@@ -256,6 +485,192 @@ def check_prompt_injection(user_input: str) -> Tuple[bool, str]:
         return False, ""
 
 
+def split_csv_answer(answer: str) -> Tuple[str, pd.DataFrame, bytes]:
+    """
+    Split a CSV_DATA answer into its display parts.
+    
+    Returns:
+        Tuple of (intro_text, preview_df, csv_bytes)
+        - intro_text: Text shown above the table
+        - preview_df: DataFrame of the preview rows (first CSV_PREVIEW_ROWS)
+        - csv_bytes: UTF-8 encoded full CSV for the download button
+    """
+    # Extract the intro text and full CSV (answers from older sessions also carry a CSV_PREVIEW section)
+    parts = answer.split("CSV_FULL:\n", 1)
+    intro_text = parts[0].split("CSV_PREVIEW:\n", 1)[0].replace("CSV_DATA:", "").strip()
+    csv_full = parts[1].strip() if len(parts) > 1 else ""
+    
+    # Parse only the first rows of the full CSV for display
+    preview_df = pd.read_csv(io.StringIO(csv_full), nrows=CSV_PREVIEW_ROWS) if csv_full else pd.DataFrame()
+    
+    return intro_text, preview_df, csv_full.encode('utf-8')
+
+
+def truncate_steps(steps: List[Any]) -> List[Any]:
+    """Truncate agent steps to their displayed length once, at write time."""
+    truncated = []
+    for step in steps:
+        if isinstance(step, dict):
+            truncated.append({
+                "action": step.get("action", "unknown"),
+                "thought": step.get("thought", ""),
+                "result": str(step.get("result", ""))[:300]
+            })
+        else:
+            truncated.append(str(step)[:200])
+    return truncated
+
+
+def save_csv_download(csv_bytes: bytes) -> str:
+    """Write a full CSV result to the session's temp directory and return the file path."""
+    if 'csv_temp_dir' not in st.session_state:
+        st.session_state.csv_temp_dir = tempfile.mkdtemp(prefix="transactions_csv_")
+    with tempfile.NamedTemporaryFile(dir=st.session_state.csv_temp_dir, suffix=".csv", delete=False) as csv_file:
+        csv_file.write(csv_bytes)
+    return csv_file.name
+
+
+def read_csv_download(csv_path: Optional[str]) -> Optional[bytes]:
+    """Read a saved CSV result for a download button, or None if it is missing."""
+    if not csv_path:
+        return None
+    try:
+        with open(csv_path, "rb") as csv_file:
+            return csv_file.read()
+    except OSError:
+        return None
+
+
+def remove_csv_download(message: Dict[str, Any], in_use: frozenset = frozenset()):
+    """Delete the CSV file backing a history message, if any, unless its path is in in_use."""
+    csv_path = message.pop("csv_path", None)
+    if csv_path and csv_path not in in_use:
+        try:
+            os.remove(csv_path)
+        except OSError:
+            pass
+
+
+def trim_session_memory():
+    """Bound the per-session chat state so long sessions do not grow without limit."""
+    # Cap the displayed conversation and drop agent steps outside the render window
+    history = st.session_state.conversation_history
+    if len(history) > CONVERSATION_HISTORY_MAX_ENTRIES:
+        # Re-asked questions share a CSV file with earlier entries and the answer cache
+        in_use = frozenset(
+            [message.get("csv_path") for message in history[-CONVERSATION_HISTORY_MAX_ENTRIES:]]
+            + [cached.get("csv_path") for cached in st.session_state.answer_cache.values()]
+        )
+        for message in history[:-CONVERSATION_HISTORY_MAX_ENTRIES]:
+            remove_csv_download(message, in_use)
+        del history[:-CONVERSATION_HISTORY_MAX_ENTRIES]
+    for message in history[:-HISTORY_RENDER_WINDOW]:
+        message.pop("intermediate_steps", None)
+
+
+@st.fragment
+def render_conversation_history():
+    """
+    Render the stored conversation history.
+    
+    Runs as a fragment so interactions inside the history (downloads, the
+    "show older" button) rerun only this block instead of the whole app.
+    """
+    history = st.session_state.conversation_history
+    
+    # Only render the most recent messages unless the user asked for the full history
+    start_idx = 0
+    if not st.session_state.get("show_older_messages") and len(history) > HISTORY_RENDER_WINDOW:
+        start_idx = len(history) - HISTORY_RENDER_WINDOW
+        if st.button(f"⬆️ Show older messages ({start_idx})", key="show_older_messages_button"):
+            st.session_state.show_older_messages = True
+            start_idx = 0
+    
+    # Display chat messages
+    for message_idx in range(start_idx, len(history)):
+        message = history[message_idx]
+        
+        # User message
+        with st.chat_message("user"):
+            st.write(message["question"])
+        
+        # Assistant message
+        with st.chat_message("assistant"):
+            # Convert legacy string-encoded CSV answers once and keep the structured fields
+            if "preview_df" not in message and message["answer"].startswith("CSV_DATA:"):
+                intro_text, preview_df, csv_bytes = split_csv_answer(message["answer"])
+                message.update(answer=intro_text, preview_df=preview_df, csv_bytes=csv_bytes)
+            if "csv_bytes" in message:
+                # Move in-memory CSV payloads to disk so session state only keeps the path
+                message["csv_path"] = save_csv_download(message.pop("csv_bytes"))
+            
+            answer = message["answer"]
+            
+            if "preview_df" in message:
+                # Display intro text
+                st.markdown(answer)
+                
+                # Display the data as a table
+                st.dataframe(message["preview_df"], use_container_width=True)
+                
+                # Provide download button for FULL CSV (all rows)
+                csv_bytes = read_csv_download(message.get("csv_path"))
+                if csv_bytes is not None:
+                    timestamp_str = message.get('timestamp', datetime.now().strftime('%Y%m%d_%H%M%S')).replace(' ', '_').replace(':', '-')
+                    st.download_button(
+                        label="📥 Download CSV (All Records)",
+                        data=csv_bytes,
+                        file_name=f"transactions_{timestamp_str}.csv",
+                        mime="text/csv",
+                        key=f"download_csv_history_{message_idx}"
+                    )
+            else:
+                st.write(answer)
+            
+            # Show additional details in expanders
+            if message.get("sql") and message["sql"] != "Agent-generated (multi-step)":
+                with st.expander("🔍 View SQL Query"):
+                    st.code(message["sql"], language="sql")
+            
+            # Show agent steps if available (always show for agentic mode)
+            intermediate_steps = message.get("intermediate_steps", [])
+            if intermediate_steps and len(intermediate_steps) > 0:
+                with st.expander("📋 View Agent Steps", expanded=False):
+                    for i, step in enumerate(intermediate_steps, 1):
+                        if isinstance(step, dict):
+                            st.markdown(f"**Step {i}: {step.get('action', 'unknown')}**")
+                            st.text(f"Thought: {step.get('thought', '')}")
+                            st.text(f"Result: {step.get('result', '')}...")
+                        else:
+                            st.text(f"Step {i}: {step}...")
+            
+            # Show execution log if available
+            if st.session_state.execution_log:
+                with st.expander("🔍 View Agent Execution Log"):
+                    # Show the most recent logs (last 10 entries)
+                    for log_entry in list(st.session_state.execution_log)[-10:]:
+                        st.text(f"[{log_entry['step']}] {log_entry['output']}")
+            
+            # Show timestamp
+            st.caption(f"• {message.get('timestamp', '')}")
+
+
+@st.fragment
+def render_examples():
+    """Render the clickable example questions; only a click triggers a full app rerun."""
+    st.markdown("### 💡 Example Questions")
+    st.markdown("Click on any question below to get started:")
+    
+    # Display example questions in columns
+    cols = st.columns(2)
+    for idx, question in enumerate(EXAMPLE_QUESTIONS):
+        with cols[idx % 2]:
+            if st.button(f"💬 {question}", key=f"example_{idx}", use_container_width=True):
+                st.session_state.example_question = question
+                st.session_state.hide_examples = True
+                st.rerun()
+
+
 # ==================== MAIN APPLICATION ====================
 
 def main():
@@ -266,7 +681,11 @@ def main():
         st.header("🏦 Bank & Account Details")
         
         # Get unique bank IDs
-        unique_bank_ids = get_unique_bank_ids()
+        try:
+            unique_bank_ids = get_unique_bank_ids()
+        except Exception as e:
+            st.error(f"❌ Could not load bank IDs: {str(e)}")
+            unique_bank_ids = []
         
         # Initialize session state for tracking bank IDs
         if 'prev_selected_bank_ids' not in st.session_state:
@@ -292,14 +711,19 @@ def main():
         selected_account_ids = []
         if selected_bank_ids:
             # Get account IDs filtered by selected bank IDs
-            available_account_ids = get_account_ids_by_bank_ids(selected_bank_ids)
+            try:
+                available_account_ids = get_account_ids_by_bank_ids(selected_bank_ids)
+            except Exception as e:
+                st.error(f"❌ Could not load account IDs: {str(e)}")
+                available_account_ids = []
             
             if available_account_ids:
                 # Filter out any invalid account IDs from session state (not in available list)
                 if 'account_ids_multiselect' in st.session_state:
                     # Keep only valid account IDs that are in the available list
+                    available_set = set(available_account_ids)
                     valid_selected = [acc_id for acc_id in st.session_state.account_ids_multiselect 
-                                     if acc_id in available_account_ids]
+                                     if acc_id in available_set]
                     st.session_state.account_ids_multiselect = valid_selected
                 else:
                     # Initialize to empty list if not exists
@@ -341,80 +765,7 @@ def main():
     chat_container = st.container()
     
     with chat_container:
-        # Display chat messages
-        for message in st.session_state.conversation_history:
-            # User message
-            with st.chat_message("user"):
-                st.write(message["question"])
-            
-            # Assistant message
-            with st.chat_message("assistant"):
-                answer = message["answer"]
-                
-                # Check if the answer is CSV data
-                if answer.startswith("CSV_DATA:"):
-                    # Extract the intro text, preview CSV, and full CSV
-                    parts = answer.split("CSV_PREVIEW:\n", 1)
-                    intro_text = parts[0].replace("CSV_DATA:", "").strip()
-                    
-                    if len(parts) > 1:
-                        csv_parts = parts[1].split("CSV_FULL:\n", 1)
-                        csv_preview = csv_parts[0].strip() if len(csv_parts) > 0 else ""
-                        csv_full = csv_parts[1].strip() if len(csv_parts) > 1 else csv_preview
-                    else:
-                        # Fallback if format is different
-                        csv_preview = parts[1].strip() if len(parts) > 1 else ""
-                        csv_full = csv_preview
-                    
-                    # Display intro text
-                    st.markdown(intro_text)
-                    
-                    # Parse preview CSV to DataFrame for display (first 100 rows)
-                    csv_df = pd.read_csv(io.StringIO(csv_preview)) if csv_preview else pd.DataFrame()
-                    
-                    # Display the data as a table
-                    st.dataframe(csv_df, use_container_width=True)
-                    
-                    # Provide download button for FULL CSV (all rows)
-                    csv_bytes = csv_full.encode('utf-8')
-                    message_idx = st.session_state.conversation_history.index(message)
-                    timestamp_str = message.get('timestamp', datetime.now().strftime('%Y%m%d_%H%M%S')).replace(' ', '_').replace(':', '-')
-                    st.download_button(
-                        label="📥 Download CSV (All Records)",
-                        data=csv_bytes,
-                        file_name=f"transactions_{timestamp_str}.csv",
-                        mime="text/csv",
-                        key=f"download_csv_history_{message_idx}"
-                    )
-                else:
-                    st.write(answer)
-                
-                # Show additional details in expanders
-                if message.get("sql") and message["sql"] != "Agent-generated (multi-step)":
-                    with st.expander("🔍 View SQL Query"):
-                        st.code(message["sql"], language="sql")
-                
-                # Show agent steps if available (always show for agentic mode)
-                intermediate_steps = message.get("intermediate_steps", [])
-                if intermediate_steps and len(intermediate_steps) > 0:
-                    with st.expander("📋 View Agent Steps", expanded=False):
-                        for i, step in enumerate(intermediate_steps, 1):
-                            if isinstance(step, dict):
-                                st.markdown(f"**Step {i}: {step.get('action', 'unknown')}**")
-                                st.text(f"Thought: {step.get('thought', '')}")
-                                st.text(f"Result: {step.get('result', '')[:300]}...")
-                            else:
-                                st.text(f"Step {i}: {str(step)[:200]}...")
-                
-                # Show execution log if available
-                if st.session_state.execution_log:
-                    with st.expander("🔍 View Agent Execution Log"):
-                        # Show the most recent logs (last 10 entries)
-                        for log_entry in st.session_state.execution_log[-10:]:
-                            st.text(f"[{log_entry['step']}] {log_entry['output'][:200]}")
-                
-                # Show timestamp
-                st.caption(f"• {message.get('timestamp', '')}")
+        render_conversation_history()
     
     # Initialize flag to hide examples if not exists
     if "hide_examples" not in st.session_state:
@@ -435,23 +786,7 @@ def main():
     
     # Example questions above chat input
     if not st.session_state.conversation_history and not st.session_state.hide_examples:
-        st.markdown("### 💡 Example Questions")
-        st.markdown("Click on any question below to get started:")
-        
-        example_questions = [
-            "How much did I spend last week?",
-            "What is the amount I have spent on Uber in the last 5 months?",
-            "How much money did I receive from amazon last month?",
-        ]
-        
-        # Display example questions in columns
-        cols = st.columns(2)
-        for idx, question in enumerate(example_questions):
-            with cols[idx % 2]:
-                if st.button(f"💬 {question}", key=f"example_{idx}", use_container_width=True):
-                    st.session_state.example_question = question
-                    st.session_state.hide_examples = True
-                    st.rerun()
+        render_examples()
     
     if prompt:
         # Check for prompt injection FIRST
@@ -496,66 +831,125 @@ def main():
                 else:
                     # Create execution log callback
                     def log_callback(log_entry: Dict):
-                        st.session_state.execution_log.append(log_entry)
+                        # Truncate once here so the log render never re-slices long outputs
+                        st.session_state.execution_log.append({**log_entry, "output": str(log_entry.get("output", ""))[:200]})
                     
-                    agent = TransactionQueryAgent(
-                        api_key=api_key,
-                        bank_ids=selected_bank_ids,
-                        account_ids=selected_account_ids,
-                        current_date=selected_date.strftime('%Y-%m-%d'),
-                        schema_getter=get_table_schema,
-                        db_connection_getter=get_db_connection,
-                        chat_history=st.session_state.llm_chat_history,
-                        execution_log_callback=log_callback,
-                        sql_cache=st.session_state.sql_cache,
-                        query_result_cache=st.session_state.query_result_cache,
-                        analysis_cache=st.session_state.analysis_cache
-                    )
+                    # Reuse the agent across questions; only its filters change between reruns
+                    agent_key = (tuple(selected_bank_ids), tuple(selected_account_ids), selected_date.isoformat())
+                    if "_agent" not in st.session_state:
+                        st.session_state._agent = TransactionQueryAgent(
+                            api_key=api_key,
+                            bank_ids=selected_bank_ids,
+                            account_ids=selected_account_ids,
+                            current_date=selected_date.strftime('%Y-%m-%d'),
+                            schema_getter=get_table_schema,
+                            db_connection_getter=get_query_connection,
+                            chat_history=st.session_state.llm_chat_history,
+                            execution_log_callback=log_callback,
+                            sql_cache=st.session_state.sql_cache,
+                            query_result_cache=st.session_state.query_result_cache,
+                            analysis_cache=st.session_state.analysis_cache,
+                            validation_cache=st.session_state.validation_cache,
+                            calculation_cache=st.session_state.calculation_cache
+                        )
+                        st.session_state._agent_key = agent_key
+                    elif st.session_state.get("_agent_key") != agent_key:
+                        st.session_state._agent.update_context(
+                            bank_ids=selected_bank_ids,
+                            account_ids=selected_account_ids,
+                            current_date=selected_date.strftime('%Y-%m-%d')
+                        )
+                        st.session_state._agent_key = agent_key
+                    agent = st.session_state._agent
                     
                     # Get context from conversation history
                     context = st.session_state.conversation_history[-5:] if st.session_state.conversation_history else []
                     
-                    result = agent.process_question(prompt, context)
+                    # Reuse the answer for a re-asked question in the same conversation context
+                    # unless the data has changed since
+                    answer_cache_key = (
+                        normalize_question(prompt),
+                        tuple(sorted(selected_bank_ids)),
+                        tuple(sorted(selected_account_ids)),
+                        selected_date.isoformat(),
+                        history_digest(st.session_state.llm_chat_history)
+                    )
+                    data_version = get_data_version()
+                    if data_version != st.session_state.answer_cache_data_version:
+                        st.session_state.answer_cache = OrderedDict()
+                        st.session_state.answer_embeddings = {}
+                        # Cleared in place: the agent holds a reference to this cache
+                        st.session_state.query_result_cache.clear()
+                        st.session_state.answer_cache_data_version = data_version
+                    
+                    result = get_from_cache(answer_cache_key, st.session_state.answer_cache)
+                    question_embedding = None
+                    if result is None:
+                        # Fall back to a semantically equivalent cached question before any LLM call
+                        question_embedding = embed_question(prompt)
+                        if question_embedding is not None:
+                            result = find_semantic_answer(answer_cache_key, prompt, question_embedding)
+                    if result is not None and "csv_path" in result and not os.path.exists(result["csv_path"]):
+                        # The CSV file behind a cached record list is gone; answer afresh
+                        result = None
+                    if result is not None:
+                        # Record the exchange as the agent would, so the next turn sees it as context
+                        st.session_state.llm_chat_history.add_user_message(prompt)
+                        st.session_state.llm_chat_history.add_ai_message(result["answer"])
+                    else:
+                        # Show the summary answer as it streams in; the final render below replaces it
+                        def show_partial_answer(partial_answer: str):
+                            message_placeholder.markdown(partial_answer.translate(_DOLLAR_ESCAPE) + " ▌")
+                        
+                        result = agent.process_question(prompt, context, answer_callback=show_partial_answer)
+                        if result["success"] and result["answer"].startswith("CSV_DATA:"):
+                            # Keep the CSV payload out of session state: the result (and the
+                            # answer cache) hold the preview and a temp-file path, as history does
+                            intro_text, preview_df, csv_bytes = split_csv_answer(result["answer"])
+                            result = {
+                                **result,
+                                "answer": intro_text,
+                                "preview_df": preview_df,
+                                "csv_path": save_csv_download(csv_bytes)
+                            }
+                        if result["success"]:
+                            set_cache(answer_cache_key, result, st.session_state.answer_cache)
+                            if question_embedding is not None:
+                                embeddings = st.session_state.answer_embeddings
+                                embeddings[answer_cache_key] = (question_embedding, question_guard_tokens(prompt))
+                                # Drop embeddings whose answers were evicted from the cache
+                                for key in [key for key in embeddings if key not in st.session_state.answer_cache]:
+                                    del embeddings[key]
+                    trim_session_memory()
                     
                     if result["success"]:
                         answer = result["answer"]
+                        csv_fields = {}
                         
-                        # Check if the answer is CSV data
-                        if answer.startswith("CSV_DATA:"):
-                            # Extract the intro text, preview CSV, and full CSV
-                            parts = answer.split("CSV_PREVIEW:\n", 1)
-                            intro_text = parts[0].replace("CSV_DATA:", "").strip()
-                            
-                            if len(parts) > 1:
-                                csv_parts = parts[1].split("CSV_FULL:\n", 1)
-                                csv_preview = csv_parts[0].strip() if len(csv_parts) > 0 else ""
-                                csv_full = csv_parts[1].strip() if len(csv_parts) > 1 else csv_preview
-                            else:
-                                # Fallback if format is different
-                                csv_preview = parts[1].strip() if len(parts) > 1 else ""
-                                csv_full = csv_preview
-                            
+                        # Check if the answer is CSV data (already split into preview + temp file)
+                        if "csv_path" in result:
                             # Display intro text
-                            message_placeholder.markdown(intro_text)
-                            
-                            # Parse preview CSV to DataFrame for display (first 100 rows)
-                            csv_df = pd.read_csv(io.StringIO(csv_preview)) if csv_preview else pd.DataFrame()
+                            message_placeholder.markdown(answer)
                             
                             # Display the data as a table
-                            st.dataframe(csv_df, use_container_width=True)
+                            st.dataframe(result["preview_df"], use_container_width=True)
+                            
+                            # Provide download button for FULL CSV (all rows), read from the session's temp file
+                            csv_bytes = read_csv_download(result["csv_path"])
+                            if csv_bytes is not None:
+                                st.download_button(
+                                    label="📥 Download CSV (All Records)",
+                                    data=csv_bytes,
+                                    file_name=f"transactions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                                    mime="text/csv",
+                                    key=f"download_csv_{len(st.session_state.conversation_history)}"
+                                )
                             
-                            # Provide download button for FULL CSV (all rows)
-                            csv_bytes = csv_full.encode('utf-8')
-                            st.download_button(
-                                label="📥 Download CSV (All Records)",
-                                data=csv_bytes,
-                                file_name=f"transactions_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                                mime="text/csv",
-                                key=f"download_csv_{len(st.session_state.conversation_history)}"
-                            )
+                            # History shares the parsed parts, so renders never re-split or re-parse the CSV
+                            csv_fields = {"preview_df": result["preview_df"], "csv_path": result["csv_path"]}
                         else:
                             # Regular text answer - escape markdown and preserve formatting
-                            message_placeholder.markdown(answer.replace("$", "\\$"))
+                            message_placeholder.markdown(answer.translate(_DOLLAR_ESCAPE) if "$" in answer else answer)
                         
                         # Show additional details in expanders
                         if result.get("sql_used"):
@@ -563,21 +957,21 @@ def main():
                                 st.code(result["sql_used"], language="sql")
                         
                         # Show agent steps
-                        intermediate_steps = result.get("intermediate_steps", [])
+                        intermediate_steps = truncate_steps(result.get("intermediate_steps", []))
                         if intermediate_steps and len(intermediate_steps) > 0:
                             with st.expander("📋 View Agent Steps", expanded=False):
                                 for i, step in enumerate(intermediate_steps, 1):
                                     if isinstance(step, dict):
                                         st.markdown(f"**Step {i}: {step.get('action', 'unknown')}**")
                                         st.text(f"Thought: {step.get('thought', '')}")
-                                        st.text(f"Result: {step.get('result', '')[:300]}...")
+                                        st.text(f"Result: {step.get('result', '')}...")
                                     else:
-                                        st.text(f"Step {i}: {str(step)[:200]}...")
+                                        st.text(f"Step {i}: {step}...")
                         
                         if st.session_state.execution_log:
                             with st.expander("🔍 View Agent Execution Log"):
-                                for log_entry in st.session_state.execution_log[-10:]:
-                                    st.text(f"[{log_entry['step']}] {log_entry['output'][:200]}")
+                                for log_entry in list(st.session_state.execution_log)[-10:]:
+                                    st.text(f"[{log_entry['step']}] {log_entry['output']}")
                         
                         st.caption(f"• {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
                         
@@ -586,16 +980,15 @@ def main():
                             "question": prompt,
                             "answer": answer,
                             "sql": result.get("sql_used", "Agent-generated (multi-step)"),
-                            "intermediate_steps": result.get("intermediate_steps", []),  # Store agent steps
+                            "intermediate_steps": intermediate_steps,  # Store truncated agent steps
                             "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                            "mode": "agentic"
+                            "mode": "agentic",
+                            **csv_fields
                         })
                         
                         # Hide examples after successful question processing
+                        # (the new message is already rendered above, so no rerun is needed)
                         st.session_state.hide_examples = True
-                        
-                        # Trigger rerun to ensure new message is visible
-                        st.rerun()
                     else:
                         error_msg = result.get('error', 'Unknown error')
                         if error_msg.startswith("ERROR: "):
@@ -611,18 +1004,18 @@ def main():
                         
                         if result.get("intermediate_steps"):
                             with st.expander("📋 View Agent Steps"):
-                                for i, step in enumerate(result["intermediate_steps"], 1):
+                                for i, step in enumerate(truncate_steps(result["intermediate_steps"]), 1):
                                     if isinstance(step, dict):
                                         st.markdown(f"**Step {i}: {step.get('action', 'unknown')}**")
                                         st.text(f"Thought: {step.get('thought', '')}")
-                                        st.text(f"Result: {step.get('result', '')[:300]}...")
+                                        st.text(f"Result: {step.get('result', '')}...")
                                     else:
-                                        st.text(f"Step {i}: {str(step)[:200]}...")
+                                        st.text(f"Step {i}: {step}...")
                         
                         if st.session_state.execution_log:
                             with st.expander("🔍 View Agent Execution Log"):
-                                for log_entry in st.session_state.execution_log[-10:]:
-                                    st.text(f"[{log_entry['step']}] {log_entry['output'][:200]}")
+                                for log_entry in list(st.session_state.execution_log)[-10:]:
+                                    st.text(f"[{log_entry['step']}] {log_entry['output']}")
                         
                         st.caption(f"• {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     
@@ -631,13 +1024,23 @@ def main():
         with st.sidebar:
             st.divider()
             if st.button("🗑️ Clear Chat History", type="secondary"):
+                for message in st.session_state.conversation_history:
+                    remove_csv_download(message)
                 st.session_state.conversation_history = []
-                st.session_state.execution_log = []
+                st.session_state.execution_log = deque(maxlen=EXECUTION_LOG_MAX_ENTRIES)
                 st.session_state.llm_chat_history.clear()
-                st.session_state.sql_cache = {}
-                st.session_state.query_result_cache = {}
-                st.session_state.analysis_cache = {}
+                st.session_state.sql_cache = OrderedDict()
+                st.session_state.query_result_cache = OrderedDict()
+                st.session_state.analysis_cache = OrderedDict()
+                st.session_state.answer_cache = OrderedDict()
+                st.session_state.answer_embeddings = {}
+                st.session_state.validation_cache = OrderedDict()
+                st.session_state.calculation_cache = OrderedDict()
+                # Drop the cached agent so it is rebuilt against the fresh caches
+                st.session_state.pop("_agent", None)
+                st.session_state.pop("_agent_key", None)
                 st.session_state.hide_examples = False
+                st.session_state.show_older_messages = False
                 st.rerun()
 
 
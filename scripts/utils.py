@@ -1,16 +1,26 @@
-import pandas as pd
 import sqlite3
-from datetime import datetime
-from typing import Optional, List, Dict, Any, Callable, Tuple
+from typing import Optional, List, Dict, Any, Callable, Tuple, Hashable, Literal
 import json
+import orjson
 import re
 import os
-import hashlib
+import sys
+import io
+import csv
+import time
+from collections import OrderedDict
+from contextlib import closing
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
 from langchain_groq import ChatGroq
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import StructuredTool
 from langchain_core.chat_history import InMemoryChatMessageHistory
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, BaseMessage
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.utils.json import parse_partial_json
+from pydantic import BaseModel, PrivateAttr
 
 """
 Utility functions and classes for Agentic AI transaction query system.
@@ -20,49 +30,181 @@ This module contains all agentic AI-related functionality including:
 - TransactionQueryAgent class for orchestrating agentic workflows
 """
 
+# ==================== LLM CLIENT ====================
+
+LLM_MODEL_NAME = "llama-3.3-70b-versatile"
+# Smaller, faster model for simple tasks (arithmetic) where the 70B model adds only latency
+CALCULATION_MODEL_NAME = "llama-3.1-8b-instant"
+
+@lru_cache(maxsize=8)
+def get_llm(api_key: str, model_name: str = LLM_MODEL_NAME, temperature: float = 0.1) -> ChatGroq:
+    """Return a shared ChatGroq client so its HTTP connection pool is reused across calls."""
+    return ChatGroq(
+        groq_api_key=api_key,
+        model_name=model_name,
+        temperature=temperature
+    )
+
+# ==================== CHAT HISTORY ====================
+
+def render_history_message(message: BaseMessage) -> Optional[Tuple[str, str]]:
+    """Render a chat message as the (role, text) pair used in the SQL prompt, or None to skip it."""
+    if isinstance(message, HumanMessage):
+        return ("human", f"Previous question: {message.content}")
+    if isinstance(message, AIMessage):
+        return ("assistant", f"Previous answer: {message.content[:200]}...")
+    return None
+
+class BoundedChatMessageHistory(InMemoryChatMessageHistory):
+    """
+    In-memory chat history that keeps only the most recent `max_messages` messages.
+    
+    Each message is also rendered for the SQL prompt once, when it is added.
+    """
+    
+    max_messages: int = 20
+    _rendered: List[Optional[Tuple[str, str]]] = PrivateAttr(default_factory=list)
+    
+    def model_post_init(self, __context: Any) -> None:
+        super().model_post_init(__context)
+        self._rendered = [render_history_message(msg) for msg in self.messages]
+    
+    def add_message(self, message: BaseMessage) -> None:
+        """Add a message and evict the oldest ones beyond max_messages."""
+        super().add_message(message)
+        self._rendered.append(render_history_message(message))
+        if len(self.messages) > self.max_messages:
+            del self.messages[:-self.max_messages]
+            del self._rendered[:-self.max_messages]
+    
+    def clear(self) -> None:
+        super().clear()
+        self._rendered = []
+    
+    def prompt_history(self, limit: int = 10) -> List[Tuple[str, str]]:
+        """Return the pre-rendered prompt pairs for the last `limit` messages."""
+        return [pair for pair in self._rendered[-limit:] if pair is not None]
+    
+    def fork(self) -> "BoundedChatMessageHistory":
+        """Return an independent, unbounded copy for speculative writes."""
+        forked = self.model_copy(update={"messages": list(self.messages), "max_messages": sys.maxsize})
+        forked._rendered = list(self._rendered)
+        return forked
+
 # ==================== CACHE UTILITY FUNCTIONS ====================
 
 def get_cache_key(question: str, bank_ids: List[int], account_ids: List[int], 
-                  current_date: Optional[str] = None, cache_type: str = "sql") -> str:
+                  current_date: Optional[str] = None, cache_type: str = "sql") -> Tuple:
     """Generate a cache key from question and parameters."""
-    # Normalize inputs
-    question_lower = question.lower().strip()
-    bank_ids_sorted = tuple(sorted(bank_ids))
-    account_ids_sorted = tuple(sorted(account_ids))
-    date_str = current_date or "none"
-    
-    # Create a unique key
-    key_string = f"{cache_type}:{question_lower}:{bank_ids_sorted}:{account_ids_sorted}:{date_str}"
-    return hashlib.md5(key_string.encode()).hexdigest()
+    # Normalized tuple; dicts hash it directly, no string formatting or digest needed
+    return (
+        cache_type,
+        question.lower().strip(),
+        tuple(sorted(bank_ids)),
+        tuple(sorted(account_ids)),
+        current_date or None,
+    )
+
+def get_validation_cache_key(question: str) -> Tuple[str, str]:
+    """Generate a cache key for a question-context verdict (it depends only on the question text)."""
+    return ("validate", question.lower().strip())
 
 def get_query_cache_key(query: str) -> str:
     """Generate a cache key for a SQL query."""
-    # Normalize query
-    query_normalized = ' '.join(query.split()).upper()
-    key_string = f"query:{query_normalized}"
-    return hashlib.md5(key_string.encode()).hexdigest()
+    # Whitespace-normalized, upper-cased query text is itself the key
+    return ' '.join(query.split()).upper()
 
-def get_from_cache(cache_key: str, cache_dict: Optional[Dict[str, Any]]) -> Optional[Any]:
-    """Retrieve value from cache if it exists."""
+def get_from_cache(cache_key: Hashable, cache_dict: Optional[OrderedDict]) -> Optional[Any]:
+    """Retrieve value from cache if it exists, marking it as most recently used."""
     if cache_dict is None:
         return None
-    return cache_dict.get(cache_key)
+    value = cache_dict.get(cache_key)
+    if value is not None:
+        cache_dict.move_to_end(cache_key)
+    return value
 
-def set_cache(cache_key: str, value: Any, cache_dict: Optional[Dict[str, Any]], max_size: int = 100):
-    """Store value in cache with size limit."""
+def set_cache(cache_key: Hashable, value: Any, cache_dict: Optional[OrderedDict], max_size: int = 100):
+    """Store value in cache with size limit (least recently used entry is evicted)."""
     if cache_dict is None:
         return
     
-    # Remove oldest entry if cache is full (FIFO)
-    if len(cache_dict) >= max_size:
-        # Remove the first (oldest) entry
-        oldest_key = next(iter(cache_dict))
-        del cache_dict[oldest_key]
+    if cache_key in cache_dict:
+        # Updating an existing entry refreshes its recency
+        cache_dict.move_to_end(cache_key)
+    elif len(cache_dict) >= max_size:
+        # Remove the least recently used entry
+        cache_dict.popitem(last=False)
     
     cache_dict[cache_key] = value
 
+# ==================== REQUEST COALESCING ====================
+
+# In-flight calls keyed by normalized request; concurrent duplicates wait on the same Future
+_inflight: Dict[Hashable, Future] = {}
+_inflight_lock = threading.Lock()
+
+def run_coalesced(key: Hashable, func: Callable, *args) -> Any:
+    """
+    Run func(*args), sharing its result (or exception) with any concurrent
+    caller that uses the same key instead of repeating the call.
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        is_owner = future is None
+        if is_owner:
+            future = Future()
+            _inflight[key] = future
+    
+    if not is_owner:
+        return future.result()
+    
+    try:
+        result = func(*args)
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+
 # ==================== HELPER FUNCTIONS ====================
 
+# Dangerous SQL operations that should be blocked, matched as whole words in one pass
+DANGEROUS_SQL_OPERATIONS = (
+    'DROP', 'DELETE', 'UPDATE', 'ALTER', 'CREATE', 'INSERT', 
+    'TRUNCATE', 'EXEC', 'EXECUTE', 'REPLACE', 'ATTACH', 'DETACH',
+    'VACUUM', 'PRAGMA', 'COMMIT', 'BEGIN', 'TRANSACTION', 'ROLLBACK'
+)
+_DANGEROUS_SQL_RE = re.compile(r'\b(?:' + '|'.join(DANGEROUS_SQL_OPERATIONS) + r')\b', re.IGNORECASE)
+
+# Patterns for stripping markdown code fences from LLM SQL output
+_SQL_FENCE_OPEN_RE = re.compile(r'^```(?:sql)?\s*', re.MULTILINE)
+_SQL_FENCE_CLOSE_RE = re.compile(r'\s*```$', re.MULTILINE)
+_JSON_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$', re.MULTILINE)
+
+# Single scan over a query: quoted literals/identifiers are matched first so nothing inside
+# them is rewritten; then bank_id / account_id filters (IN (...), bare IN 1,2 and = 3 forms)
+# and schema-qualified references to the transactions table
+_ID_FILTER_RE = re.compile(
+    r"(?P<quoted>'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")"
+    r'|\b(?P<col>bank_id|account_id)\s*'
+    r'(?:IN\s*\([^)]+\)'
+    r'|IN\s+\d+(?:\s*,\s*\d+)*'
+    r"|=\s*'?\d+'?)"
+    r'|\bmain\s*\.\s*(?P<table>"?transactions"?)',
+    re.IGNORECASE
+)
+
+# Scoping CTE added by apply_id_filters; it shadows the transactions table for the whole query
+_ID_SCOPE_CTE = "WITH transactions AS (SELECT * FROM main.transactions WHERE bank_id IN ({bank_ids}) AND account_id IN ({account_ids})) "
+_ID_SCOPE_CTE_RE = re.compile(
+    r'^WITH transactions AS \(SELECT \* FROM main\.transactions '
+    r'WHERE bank_id IN \([\d,]*\) AND account_id IN \([\d,]*\)\) '
+)
+
 def validate_sql_query(
     sql_query: str,
     question: str,
@@ -75,106 +217,101 @@ def validate_sql_query(
     """
     sql_validation_error_msg = "ERROR: I apologize, but I'm unable to process your question. Please rephrase it as a question about viewing or analyzing your transaction data."
     
-    sql_upper = sql_query.upper().strip()
-    
-    # List of dangerous SQL operations that should be blocked
-    dangerous_operations = [
-        'DROP', 'DELETE', 'UPDATE', 'ALTER', 'CREATE', 'INSERT', 
-        'TRUNCATE', 'EXEC', 'EXECUTE', 'REPLACE', 'ATTACH', 'DETACH',
-        'VACUUM', 'PRAGMA', 'COMMIT', 'BEGIN', 'TRANSACTION', 'ROLLBACK'
-    ]
+    # Only the leading keyword is uppercased; the dangerous-operation scan is case-insensitive
+    sql_stripped = sql_query.strip()
     
     # Check if query starts with SELECT
-    if not sql_upper.startswith('SELECT'):
+    if sql_stripped[:6].upper() != 'SELECT':
         if execution_log_callback:
             execution_log_callback({
                 "step": step_name,
                 "input": question,
                 "output": sql_validation_error_msg,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         return False, sql_validation_error_msg
     
     # Check for dangerous operations anywhere in the query
-    for operation in dangerous_operations:
-        pattern = r'\b' + re.escape(operation) + r'\b'
-        if re.search(pattern, sql_upper):
-            if execution_log_callback:
-                execution_log_callback({
-                    "step": step_name,
-                    "input": question,
-                    "output": sql_validation_error_msg,
-                    "timestamp": datetime.now().isoformat()
-                })
-            return False, sql_validation_error_msg
+    if _DANGEROUS_SQL_RE.search(sql_stripped):
+        if execution_log_callback:
+            execution_log_callback({
+                "step": step_name,
+                "input": question,
+                "output": sql_validation_error_msg,
+                "timestamp_ns": time.time_ns()
+            })
+        return False, sql_validation_error_msg
     
     return True, ""
 
-# ==================== TOOL FUNCTIONS ====================
+def fetch_limited_rows(conn: sqlite3.Connection, query: str, limit: int = 100) -> Tuple[List[str], List[tuple], int]:
+    """
+    Execute a query and fetch at most `limit` rows.
+    Returns (column_names, rows, total_row_count); remaining rows are counted, not kept.
+    """
+    cursor = conn.execute(query)
+    columns = [col[0] for col in cursor.description]
+    rows = cursor.fetchmany(limit + 1)
+    row_count = len(rows)
+    if row_count > limit:
+        # Count the remaining rows without materializing them
+        row_count += sum(1 for _ in cursor)
+        rows = rows[:limit]
+    return columns, rows, row_count
 
-def tool_generate_sql(
-    question: str,
-    schema: str,
-    api_key: str,
-    bank_ids: Optional[List[int]] = None,
-    account_ids: Optional[List[int]] = None,
-    current_date: Optional[str] = None,
-    chat_history: Optional[InMemoryChatMessageHistory] = None,
-    execution_log_callback: Optional[Callable] = None,
-    sql_cache: Optional[Dict[str, str]] = None
-) -> str:
+def rows_to_csv(columns: List[str], rows) -> str:
+    """Write a header and an iterable of row value sequences to a CSV string."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+def rewrite_id_filters(sql_query: str, bank_ids: List[int], account_ids: List[int]) -> str:
     """
-    Tool: Generate SQL query from natural language question.
+    Rewrite the bank_id / account_id filters a query already has to the selected IDs.
+    Text inside string literals and quoted identifiers is left untouched.
     """
-    # Validate mandatory parameters
-    if not bank_ids or len(bank_ids) == 0:
-        return f"ERROR: bank_ids is required and must contain at least one ID"
-    if not account_ids or len(account_ids) == 0:
-        return f"ERROR: account_ids is required and must contain at least one ID"
+    id_lists = {
+        "bank_id": ','.join(map(str, bank_ids)),
+        "account_id": ','.join(map(str, account_ids)),
+    }
     
-    # Check cache first
-    if sql_cache is not None:
-        cache_key = get_cache_key(question, bank_ids, account_ids, current_date, "sql")
-        cached_sql = get_from_cache(cache_key, sql_cache)
-        if cached_sql:
-            if execution_log_callback:
-                execution_log_callback({
-                    "step": "generate_sql",
-                    "input": question,
-                    "output": f"[CACHED] {cached_sql[:100]}...",
-                    "timestamp": datetime.now().isoformat()
-                })
-            return cached_sql
+    def rewrite(match: re.Match) -> str:
+        if match.group('col'):
+            col = match.group('col').lower()
+            return f"{col} IN ({id_lists[col]})"
+        if match.group('table'):
+            # main.transactions would bypass the scoping CTE
+            return match.group('table')
+        return match.group('quoted')
     
-    try:
-        llm = ChatGroq(
-            groq_api_key=api_key,
-            model_name="llama-3.3-70b-versatile",
-            temperature=0.1
-        )
-        
-        # Use current_date if provided, otherwise use 'now'
-        if current_date:
-            date_ref = f"'{current_date}'"
-            date_ref_sql = f"DATE('{current_date}')"
-            datetime_ref_sql = f"datetime('{current_date}')"
-        else:
-            date_ref = "'now'"
-            date_ref_sql = "DATE('now')"
-            datetime_ref_sql = "datetime('now')"
-        
-        # Build filter clauses for bank_id and account_id (mandatory fields)
-        bank_ids_str = ','.join(map(str, bank_ids))
-        account_ids_str = ','.join(map(str, account_ids))
-        filter_examples = f"\n  - MANDATORY filter by bank_id: bank_id IN ({bank_ids_str})\n  - MANDATORY filter by account_id: account_id IN ({account_ids_str})"
-        
-        # Build prompt with date variables formatted
-        current_date_ref_text = 'today (use DATE(\'now\'))' if not current_date else current_date
-        
-        prompt_text = f"""You are a SQL expert. Given a database schema and a natural language question, generate a SQL query to answer it.
+    return _ID_FILTER_RE.sub(rewrite, sql_query)
+
+def apply_id_filters(sql_query: str, bank_ids: List[int], account_ids: List[int]) -> str:
+    """
+    Restrict a query to the selected bank / account IDs.
+    
+    Existing filters are rewritten (rewrite_id_filters), then a CTE named transactions
+    that holds only the selected IDs' rows is prepended. Every reference to the table,
+    in any UNION branch, subquery or OR'ed condition, reads the filtered rows.
+    Applying it again replaces the previous CTE.
+    """
+    sql_query = _ID_SCOPE_CTE_RE.sub('', sql_query.strip())
+    sql_query = rewrite_id_filters(sql_query, bank_ids, account_ids)
+    scope = _ID_SCOPE_CTE.format(
+        bank_ids=','.join(map(str, bank_ids)),
+        account_ids=','.join(map(str, account_ids))
+    )
+    return scope + sql_query
+
+# ==================== PROMPTS ====================
+
+# SQL generation prompt, parsed once; per-call values are template variables
+_SQL_GENERATION_TEMPLATE = """You are a SQL expert. Given a database schema and a natural language question, generate a SQL query to answer it.
 
                         Database Schema:
-                        {{schema}}
+                        {schema}
 
                         Important Notes:
                         - Use ONLY SQLite date/time functions: DATE(), datetime(), strftime()
@@ -254,72 +391,107 @@ def tool_generate_sql(
 
                         Now, given the following question, generate ONLY the SQL query, nothing else. Do not include markdown formatting, just the raw SQL query.:
 
-                        Question: {{question}}"""
-        
-        # Build messages with chat history
-        messages = []
+                        Question: {question}"""
+
+_SQL_GENERATION_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", "You are a SQL expert. Generate only SQL queries without any explanation or markdown formatting."),
+    MessagesPlaceholder("history", optional=True),
+    ("human", _SQL_GENERATION_TEMPLATE),
+])
+
+# ==================== TOOL FUNCTIONS ====================
+
+def tool_generate_sql(
+    question: str,
+    schema: str,
+    api_key: str,
+    bank_ids: Optional[List[int]] = None,
+    account_ids: Optional[List[int]] = None,
+    current_date: Optional[str] = None,
+    chat_history: Optional[InMemoryChatMessageHistory] = None,
+    execution_log_callback: Optional[Callable] = None,
+    sql_cache: Optional[OrderedDict] = None
+) -> str:
+    """
+    Tool: Generate SQL query from natural language question.
+    """
+    # Validate mandatory parameters
+    if not bank_ids or len(bank_ids) == 0:
+        return f"ERROR: bank_ids is required and must contain at least one ID"
+    if not account_ids or len(account_ids) == 0:
+        return f"ERROR: account_ids is required and must contain at least one ID"
+    
+    # Check cache first
+    if sql_cache is not None:
+        cache_key = get_cache_key(question, bank_ids, account_ids, current_date, "sql")
+        cached_sql = get_from_cache(cache_key, sql_cache)
+        if cached_sql:
+            if execution_log_callback:
+                execution_log_callback({
+                    "step": "generate_sql",
+                    "input": question,
+                    "output": f"[CACHED] {cached_sql[:100]}...",
+                    "timestamp_ns": time.time_ns()
+                })
+            return cached_sql
+    
+    try:
+        llm = get_llm(api_key)
         
-        # Add system message
-        messages.append(("system", "You are a SQL expert. Generate only SQL queries without any explanation or markdown formatting."))
+        # Use current_date if provided, otherwise use 'now'
+        if current_date:
+            date_ref = f"'{current_date}'"
+            date_ref_sql = f"DATE('{current_date}')"
+            datetime_ref_sql = f"datetime('{current_date}')"
+        else:
+            date_ref = "'now'"
+            date_ref_sql = "DATE('now')"
+            datetime_ref_sql = "datetime('now')"
         
-        # Add chat history if available
-        if chat_history:
-            history_messages = chat_history.messages[-10:]
-            for msg in history_messages:
-                if isinstance(msg, HumanMessage):
-                    messages.append(("human", f"Previous question: {msg.content}"))
-                elif isinstance(msg, AIMessage):
-                    messages.append(("assistant", f"Previous answer: {msg.content[:200]}..."))
+        # Build filter clauses for bank_id and account_id (mandatory fields)
+        bank_ids_str = ','.join(map(str, bank_ids))
+        account_ids_str = ','.join(map(str, account_ids))
+        filter_examples = f"\n  - MANDATORY filter by bank_id: bank_id IN ({bank_ids_str})\n  - MANDATORY filter by account_id: account_id IN ({account_ids_str})"
         
-        # Add current prompt
-        messages.append(("human", prompt_text))
+        # Current date text for the prompt
+        current_date_ref_text = 'today (use DATE(\'now\'))' if not current_date else current_date
         
-        prompt_template = ChatPromptTemplate.from_messages(messages)
-        chain = prompt_template | llm
-        response = chain.invoke({
+        # Build chat history messages (inserted as-is, not parsed as templates)
+        history = []
+        if isinstance(chat_history, BoundedChatMessageHistory):
+            history = chat_history.prompt_history(10)
+        elif chat_history:
+            for msg in chat_history.messages[-10:]:
+                pair = render_history_message(msg)
+                if pair is not None:
+                    history.append(pair)
+        
+        # Identical prompts already in flight (e.g. the same question from another session)
+        # share one LLM call
+        inflight_key = (
+            get_cache_key(question, bank_ids, account_ids, current_date, "sql"),
+            tuple(history)
+        )
+        chain = _SQL_GENERATION_PROMPT | llm
+        response = run_coalesced(inflight_key, chain.invoke, {
             "schema": schema, 
-            "question": question
+            "question": question,
+            "history": history,
+            "current_date_ref_text": current_date_ref_text,
+            "date_ref": date_ref,
+            "date_ref_sql": date_ref_sql,
+            "datetime_ref_sql": datetime_ref_sql,
+            "filter_examples": filter_examples
         })
         
         raw_sql_output = response.content.strip()
         # Remove markdown code blocks if present
-        sql_query = re.sub(r'^```(?:sql)?\s*', '', raw_sql_output, flags=re.MULTILINE)
-        sql_query = re.sub(r'\s*```$', '', sql_query, flags=re.MULTILINE)
+        sql_query = _SQL_FENCE_OPEN_RE.sub('', raw_sql_output)
+        sql_query = _SQL_FENCE_CLOSE_RE.sub('', sql_query)
         sql_query = sql_query.strip()
         
-        # ALWAYS add bank_id and account_id filters to the query
-        bank_ids_str = ','.join(map(str, bank_ids))
-        account_ids_str = ','.join(map(str, account_ids))
-        
-        if "bank_id" not in sql_query.lower():
-            if "WHERE" in sql_query.upper():
-                sql_query = sql_query + f" AND bank_id IN ({bank_ids_str})"
-            else:
-                sql_query = sql_query + f" WHERE bank_id IN ({bank_ids_str})"
-        else:
-            # Replace existing bank_id filter
-            sql_query = re.sub(
-                r'bank_id\s+IN\s*\([^)]+\)',
-                f'bank_id IN ({bank_ids_str})',
-                sql_query,
-                flags=re.IGNORECASE
-            )
-        
-        if "account_id" not in sql_query.lower():
-            if "WHERE" in sql_query.upper():
-                sql_query = sql_query + f" AND account_id IN ({account_ids_str})"
-            else:
-                sql_query = sql_query + f" WHERE account_id IN ({account_ids_str})"
-        else:
-            # Replace existing account_id filter to ensure correct values
-            sql_query = re.sub(
-                r'account_id\s+IN\s*\([^)]+\)',
-                f'account_id IN ({account_ids_str})',
-                sql_query,
-                flags=re.IGNORECASE
-            )
-        
-        # Validate SQL query for dangerous operations
+        # Validate the LLM output for dangerous operations once, before the ID filters are
+        # rewritten; that only changes numeric ID lists, so the final query needs no re-scan
         is_valid, error_msg = validate_sql_query(
             sql_query,
             question,
@@ -329,6 +501,10 @@ def tool_generate_sql(
         if not is_valid:
             return error_msg
         
+        # Point the query's own bank_id / account_id filters at the selected IDs; the
+        # IDs are enforced when the query is executed (apply_id_filters)
+        sql_query = rewrite_id_filters(sql_query, bank_ids, account_ids)
+        
         # Store raw LLM output in chat_history
         if chat_history:
             # Add raw SQL output
@@ -347,7 +523,7 @@ def tool_generate_sql(
                 "step": "generate_sql",
                 "input": question,
                 "output": sql_query,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         
         return sql_query
@@ -358,7 +534,7 @@ def tool_generate_sql(
                 "step": "generate_sql",
                 "input": question,
                 "output": error_msg,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         return error_msg
 
@@ -369,7 +545,7 @@ def tool_execute_query(
     account_ids: Optional[List[int]],
     get_db_connection_func: Callable,
     execution_log_callback: Optional[Callable] = None,
-    query_result_cache: Optional[Dict[str, str]] = None
+    query_result_cache: Optional[OrderedDict] = None
 ) -> str:
     """Tool: Execute SQL query and return results as JSON string."""
     try:
@@ -379,40 +555,9 @@ def tool_execute_query(
         if not account_ids or len(account_ids) == 0:
             return f"ERROR: account_ids is required and must contain at least one ID"
         
-        # Replace or add bank_id filter first 
+        # Replace or add bank_id / account_id filters
         original_query = query
-        if bank_ids and len(bank_ids) > 0:
-            bank_ids_str = ','.join(map(str, bank_ids))
-            if "bank_id" in query.lower():
-                query = re.sub(
-                    r'bank_id\s+IN\s*\([^)]+\)',
-                    f'bank_id IN ({bank_ids_str})',
-                    query,
-                    flags=re.IGNORECASE
-                )
-            else:
-                # Add bank_id filter
-                if "WHERE" in query.upper():
-                    query = query + f" AND bank_id IN ({bank_ids_str})"
-                else:
-                    query = query + f" WHERE bank_id IN ({bank_ids_str})"
-        
-        # Replace or add account_id filter
-        if account_ids and len(account_ids) > 0:
-            account_ids_str = ','.join(map(str, account_ids))
-            if "account_id" in query.lower():
-                query = re.sub(
-                    r'account_id\s+IN\s*\([^)]+\)',
-                    f'account_id IN ({account_ids_str})',
-                    query,
-                    flags=re.IGNORECASE
-                )
-            else:
-                # Add account_id filter
-                if "WHERE" in query.upper():
-                    query = query + f" AND account_id IN ({account_ids_str})"
-                else:
-                    query = query + f" WHERE account_id IN ({account_ids_str})"
+        query = apply_id_filters(query, bank_ids, account_ids)
         
         # Check cache after query normalization
         if query_result_cache is not None:
@@ -424,44 +569,49 @@ def tool_execute_query(
                         "step": "execute_query",
                         "input": query[:100] + "..." if len(query) > 100 else query,
                         "output": "[CACHED] Query result retrieved from cache",
-                        "timestamp": datetime.now().isoformat()
+                        "timestamp_ns": time.time_ns()
                     })
                 return cached_result
         
+        # Identical queries already running in another session share one execution
         conn = get_db_connection_func()
-        df = pd.read_sql_query(query, conn)
-        conn.close()
+        columns, rows, row_count = run_coalesced(
+            ("execute_query", get_query_cache_key(query)),
+            fetch_limited_rows,
+            conn,
+            query
+        )
         
         # Convert to JSON for agent to process
-        if df.empty:
+        if row_count == 0:
             result = {"status": "empty", "message": "I couldn't find any transactions matching your criteria. Please try adjusting your search filters or date range.", "count": 0}
         else:
-            # Limit rows for token efficiency
-            if len(df) > 100:
+            records = [dict(zip(columns, row)) for row in rows]
+            if row_count > 100:
                 result = {
                     "status": "success",
-                    "count": len(df),
-                    "rows": df.head(100).to_dict('records'),
-                    "message": f"Showing first 100 of {len(df)} rows"
+                    "count": row_count,
+                    "rows": records,
+                    "message": f"Showing first 100 of {row_count} rows"
                 }
             else:
                 result = {
                     "status": "success",
-                    "count": len(df),
-                    "rows": df.to_dict('records')
+                    "count": row_count,
+                    "rows": records
                 }
         
         log_entry = {
             "step": "execute_query",
             "input": query,
             "output": f"Success: {result['count']} rows",
-            "timestamp": datetime.now().isoformat()
+            "timestamp_ns": time.time_ns()
         }
         
         if execution_log_callback:
             execution_log_callback(log_entry)
         
-        exec_result = json.dumps(result, default=str)
+        exec_result = orjson.dumps(result, default=str).decode()
         
         # Store in cache
         if query_result_cache is not None:
@@ -476,7 +626,7 @@ def tool_execute_query(
                 "step": "execute_query",
                 "input": query,
                 "output": error_msg,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         return error_msg
 
@@ -484,17 +634,27 @@ def tool_execute_query(
 def tool_validate_question_context(
     question: str, 
     api_key: str,
-    execution_log_callback: Optional[Callable] = None
+    execution_log_callback: Optional[Callable] = None,
+    validation_cache: Optional[OrderedDict] = None
 ) -> str:
     """
     Tool: Validate if the question is related to bank transactions.
     """
+    # Check cache first (the verdict depends only on the question text)
+    cache_key = get_validation_cache_key(question)
+    cached_result = get_from_cache(cache_key, validation_cache)
+    if cached_result:
+        if execution_log_callback:
+            execution_log_callback({
+                "step": "validate_question_context",
+                "input": question,
+                "output": f"[CACHED] Valid: {orjson.loads(cached_result)['valid']}",
+                "timestamp_ns": time.time_ns()
+            })
+        return cached_result
+    
     try:
-        llm = ChatGroq(
-            groq_api_key=api_key,
-            model_name="llama-3.3-70b-versatile",
-            temperature=0.1
-        )
+        llm = get_llm(api_key)
         
         prompt_template = ChatPromptTemplate.from_messages([
             ("system", "You are a helpful assistant that determines if questions are related to bank transactions and financial data."),
@@ -550,10 +710,15 @@ def tool_validate_question_context(
                 "step": "validate_question_context",
                 "input": question,
                 "output": f"Valid: {is_valid}",
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         
-        return json.dumps(result)
+        validation_result = json.dumps(result)
+        
+        # Store in cache (fail-open results below are never cached)
+        set_cache(cache_key, validation_result, validation_cache)
+        
+        return validation_result
         
     except Exception as e:
         # On error, allow the question through (fail open)
@@ -566,26 +731,32 @@ def tool_validate_question_context(
                 "step": "validate_question_context",
                 "input": question,
                 "output": f"Error (fail open): {str(e)}",
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         return json.dumps(result)
 
 
-def tool_refine_query(
+# Number of alternative fixes requested from a single refine call
+REFINE_CANDIDATES = 3
+
+def tool_refine_query_candidates(
     original_query: str, 
     error_message: str, 
     question: str, 
     schema: str, 
     api_key: str,
-    execution_log_callback: Optional[Callable] = None
-) -> str:
-    """Tool: Refine a SQL query based on error feedback."""
+    execution_log_callback: Optional[Callable] = None,
+    num_candidates: int = REFINE_CANDIDATES
+) -> Tuple[List[str], Optional[str]]:
+    """
+    Tool: Ask for several refined SQL queries in one LLM call.
+    
+    Returns:
+        Tuple of (candidates, error); candidates are validated queries ordered by
+        likelihood of correctness, and error is set when none are usable
+    """
     try:
-        llm = ChatGroq(
-            groq_api_key=api_key,
-            model_name="llama-3.3-70b-versatile",
-            temperature=0.1
-        )
+        llm = get_llm(api_key)
         
         prompt_template = ChatPromptTemplate.from_messages([
             ("system", "You are a SQL expert. Fix SQL errors by refining queries."),
@@ -602,9 +773,10 @@ def tool_refine_query(
             Database Schema:
             {schema}
 
-            Please provide a corrected SQL query. Return ONLY the SQL query, no explanations, no markdown.
+            Return a JSON array of {num_candidates} candidate corrected SQL queries (strings), ordered by likelihood of correctness.
+            Return ONLY the JSON array, no explanations, no markdown.
 
-            Corrected Query:""")
+            Corrected Queries:""")
         ])
         
         chain = prompt_template | llm
@@ -612,40 +784,46 @@ def tool_refine_query(
             "question": question,
             "original_query": original_query,
             "error_message": error_message,
-            "schema": schema
+            "schema": schema,
+            "num_candidates": num_candidates
         })
         
-        refined_query = response.content.strip()
-        refined_query = re.sub(r'^```(?:sql)?\s*', '', refined_query, flags=re.MULTILINE)
-        refined_query = re.sub(r'\s*```$', '', refined_query, flags=re.MULTILINE)
-        refined_query = refined_query.strip()
-        
-        # Validate the refined query for security
-        is_valid, error_msg = validate_sql_query(
-            refined_query,
-            question,
-            execution_log_callback,
-            "refine_query"
-        )
-        if not is_valid:
-            if execution_log_callback:
-                execution_log_callback({
-                    "step": "refine_query",
-                    "input": f"Error: {error_message}",
-                    "output": error_msg,
-                    "timestamp": datetime.now().isoformat()
-                })
-            return error_msg
+        raw_output = _JSON_FENCE_RE.sub('', response.content.strip()).strip()
+        try:
+            parsed = orjson.loads(raw_output)
+            raw_candidates = [parsed] if isinstance(parsed, str) else [str(query) for query in parsed]
+        except (orjson.JSONDecodeError, TypeError):
+            # Not a JSON array: treat the whole output as a single query
+            raw_candidates = [raw_output]
+        
+        candidates = []
+        error_msg = "ERROR: No refined query returned"
+        for refined_query in raw_candidates[:num_candidates]:
+            refined_query = _SQL_FENCE_OPEN_RE.sub('', refined_query)
+            refined_query = _SQL_FENCE_CLOSE_RE.sub('', refined_query)
+            refined_query = refined_query.strip()
+            
+            # Validate each refined query for security
+            is_valid, validation_error = validate_sql_query(
+                refined_query,
+                question,
+                execution_log_callback,
+                "refine_query"
+            )
+            if is_valid:
+                candidates.append(refined_query)
+            else:
+                error_msg = validation_error
         
         if execution_log_callback:
             execution_log_callback({
                 "step": "refine_query",
                 "input": f"Error: {error_message}",
-                "output": refined_query,
-                "timestamp": datetime.now().isoformat()
+                "output": "\n---\n".join(candidates) if candidates else error_msg,
+                "timestamp_ns": time.time_ns()
             })
         
-        return refined_query
+        return candidates, None if candidates else error_msg
     except Exception as e:
         error_msg = f"ERROR: {str(e)}"
         if execution_log_callback:
@@ -653,9 +831,250 @@ def tool_refine_query(
                 "step": "refine_query",
                 "input": f"Error: {error_message}",
                 "output": error_msg,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
-        return error_msg
+        return [], error_msg
+
+
+def tool_refine_query(
+    original_query: str, 
+    error_message: str, 
+    question: str, 
+    schema: str, 
+    api_key: str,
+    execution_log_callback: Optional[Callable] = None
+) -> str:
+    """Tool: Refine a SQL query based on error feedback."""
+    candidates, error_msg = tool_refine_query_candidates(
+        original_query, error_message, question, schema, api_key, execution_log_callback, num_candidates=1
+    )
+    return candidates[0] if candidates else error_msg
+
+
+class AnalysisResult(BaseModel):
+    """Structured output of the combined classify-and-analyze LLM call."""
+    mode: Literal["RECORDS", "SUMMARY"] = "SUMMARY"
+    answer: str = ""
+
+
+# Parses (possibly fenced) JSON output straight into an AnalysisResult
+_ANALYSIS_PARSER = PydanticOutputParser(pydantic_object=AnalysisResult)
+
+# Questions that clearly ask to show/list transaction records (no LLM classification needed):
+# the request verb must be followed directly by the records ("show me all my transactions ...").
+# Anything mentioning totals, summaries or rankings is left to the LLM
+_RECORD_LIST_QUESTION_RE = re.compile(
+    r'^(?!.*\b(?:total|sum|summary|summari[sz]e|average|avg|how much|how many|count|most|least|'
+    r'spent|spend|spending|breakdown|overview|top|biggest|largest|highest|lowest)\b)'
+    r'\W*(?:please\s+)?(?:show|list|display)(?:\s+me)?(?:\s+all)?(?:\s+(?:of\s+)?my)?'
+    r'\s+(?:transactions?|records?|purchases?)\b',
+    re.IGNORECASE
+)
+
+# Answer-writing rules shared by the combined call and the plain summary fallback
+_SUMMARY_ANSWER_INSTRUCTIONS = """- Answer only what was asked, nothing more
+            - Be brief and direct
+            - Format currency amounts with dollar signs and proper commas (e.g., $1,234.56)
+            - Do not explain the data or provide context
+            - Do not add summaries or interpretations beyond what's directly in the results
+            - Keep responses minimal and factual
+            - Write in plain text with normal spacing - do not remove spaces between words
+            - Remove negative sign from amounts
+            
+            Examples:
+            Example 1 (Summary):
+            Question: How much did I spend last week?
+            Response: You spent $1,234.56 last week.
+
+            Example 2 (Calculation):
+            Question: Compare my last month spending with this month?
+            Response: You spent $234.56 more this month than last month."""
+
+
+def _analysis_prompt(prompt_text: str, chat_history: Optional[InMemoryChatMessageHistory]) -> ChatPromptTemplate:
+    """Build the analyst prompt: system message, recent chat history, then the analysis request."""
+    messages = [("system", "You are a data analyst. Analyze query results and provide insights. Provide natural language summaries for calculation questions.")]
+    
+    # Add chat history if available
+    if chat_history:
+        history_messages = chat_history.messages[-10:]  # Last 10 messages (5 exchanges)
+        for msg in history_messages:
+            if isinstance(msg, HumanMessage):
+                messages.append(("human", msg.content))
+            elif isinstance(msg, AIMessage):
+                messages.append(("assistant", msg.content))
+    
+    messages.append(("human", prompt_text))
+    return ChatPromptTemplate.from_messages(messages)
+
+
+def _detect_record_list_question(question: str, api_key: str) -> bool:
+    """Ask the LLM whether the question wants transaction records (RECORDS) or a summary."""
+    try:
+        detection_llm = get_llm(api_key)
+        
+        detection_prompt = ChatPromptTemplate.from_messages([
+            ("system", "You are a question classifier. Determine if a question is asking to SHOW/LIST/DISPLAY transaction records or asking for a SUMMARY/TOTAL/CALCULATION."),
+            ("human", """Classify the following question:
+
+            Question: {question}
+
+            Determine if this question is asking to:
+            - SHOW/LIST/DISPLAY transaction records (e.g., "show me transactions", "list all transactions", "display my purchases")
+            - OR asking for a SUMMARY/TOTAL/CALCULATION (e.g., "how much", "total spending", "what's my balance")
+
+            Respond with ONLY one word: either "RECORDS" or "SUMMARY".
+            """)
+        ])
+        
+        detection_chain = detection_prompt | detection_llm
+        detection_response = detection_chain.invoke({"question": question})
+        return "RECORD" in detection_response.content.strip().upper()
+    except Exception:
+        # On error, default to summary
+        return False
+
+
+def _answer_summary(
+    question: str,
+    sample_rows: str,
+    count: int,
+    api_key: str,
+    calculation_context: str,
+    chat_history: Optional[InMemoryChatMessageHistory] = None,
+    answer_callback: Optional[Callable[[str], None]] = None
+) -> str:
+    """Answer a summary question in plain text (no classification, no JSON wrapper)."""
+    llm = get_llm(api_key, temperature=0.3)
+    
+    prompt_text = f"""Analyze these query results and answer the user's question.
+
+            Question: {{question}}
+
+            Results (JSON):
+            {{sample_rows}}
+
+            Total rows: {{count}}
+            
+            {calculation_context}
+
+            Instructions:
+            {_SUMMARY_ANSWER_INSTRUCTIONS}
+            """
+    
+    chain = _analysis_prompt(prompt_text, chat_history) | llm
+    inputs = {
+        "question": question,
+        "sample_rows": sample_rows,
+        "count": count
+    }
+    
+    if answer_callback is None:
+        return chain.invoke(inputs).content.strip()
+    
+    answer = ""
+    for chunk in chain.stream(inputs):
+        answer += chunk.content
+        if chunk.content:
+            answer_callback(answer)
+    return answer.strip()
+
+
+def _analyze_summary(
+    question: str,
+    rows: List[Dict],
+    count: int,
+    api_key: str,
+    calculation_result: Optional[str] = None,
+    chat_history: Optional[InMemoryChatMessageHistory] = None,
+    answer_callback: Optional[Callable[[str], None]] = None
+) -> Tuple[Optional[str], bool]:
+    """
+    Classify the question and, for summary questions, answer it in a single LLM call.
+    
+    If answer_callback is given, the response is streamed and the callback receives the
+    summary answer text accumulated so far each time it grows. If the output is not valid
+    JSON, the question is classified and answered with separate calls instead.
+    
+    Returns:
+        Tuple of (analysis, is_record_list_question); analysis is None for record-list questions
+    """
+    llm = get_llm(api_key, temperature=0.3)
+    
+    # Limit to 20 rows for summary questions
+    sample_rows = orjson.dumps(rows[:20], default=str).decode()
+    
+    # Build prompt with optional calculation result
+    calculation_context = ""
+    if calculation_result and not calculation_result.startswith("ERROR"):
+        clean_calc_result = " ".join(calculation_result.split()).strip()
+        calculation_context = f"\n\nAdditional Information: The calculation result is {clean_calc_result}. Use this value naturally in your answer."
+    
+    prompt_text = f"""Analyze these query results and answer the user's question.
+
+            Question: {{question}}
+
+            Results (JSON):
+            {{sample_rows}}
+
+            Total rows: {{count}}
+            
+            {calculation_context}
+
+            First classify the question:
+            - "RECORDS" if it asks to SHOW/LIST/DISPLAY transaction records (e.g., "show me transactions", "list all transactions", "display my purchases")
+            - "SUMMARY" if it asks for a SUMMARY/TOTAL/CALCULATION (e.g., "how much", "total spending", "what's my balance")
+
+            For SUMMARY questions, write the answer following these instructions:
+            {_SUMMARY_ANSWER_INSTRUCTIONS}
+
+            For RECORDS questions, leave "answer" empty.
+
+            Return your response in the following JSON format:
+            {{{{
+                "mode": "RECORDS" or "SUMMARY",
+                "answer": "the answer for SUMMARY questions"
+            }}}}
+            """
+    
+    chain = _analysis_prompt(prompt_text, chat_history) | llm
+    inputs = {
+        "question": question,
+        "sample_rows": sample_rows,
+        "count": count
+    }
+    
+    if answer_callback is None:
+        raw_output = chain.invoke(inputs).content.strip()  # Raw LLM output
+    else:
+        # Parse the partial JSON as tokens arrive and report the answer field as it grows
+        raw_output = ""
+        streamed_answer = ""
+        for chunk in chain.stream(inputs):
+            raw_output += chunk.content
+            try:
+                partial = parse_partial_json(_JSON_FENCE_RE.sub('', raw_output).strip())
+            except json.JSONDecodeError:
+                continue
+            if isinstance(partial, dict) and partial.get("mode") == "SUMMARY":
+                answer = partial.get("answer")
+                if isinstance(answer, str) and len(answer) > len(streamed_answer):
+                    streamed_answer = answer
+                    answer_callback(streamed_answer)
+        raw_output = raw_output.strip()
+    try:
+        result = _ANALYSIS_PARSER.parse(raw_output)
+    except Exception:
+        # Not valid JSON: fall back to a separate classification call, then a plain summary call
+        if _detect_record_list_question(question, api_key):
+            return None, True
+        return _answer_summary(
+            question, sample_rows, count, api_key, calculation_context, chat_history, answer_callback
+        ), False
+    
+    if result.mode == "RECORDS":
+        return None, True
+    return result.answer.strip(), False
 
 
 def tool_analyze_results(
@@ -668,11 +1087,12 @@ def tool_analyze_results(
     sql_query: Optional[str] = None,
     db_connection_getter: Optional[Callable] = None,
     bank_ids: Optional[List[int]] = None,
-    account_ids: Optional[List[int]] = None
+    account_ids: Optional[List[int]] = None,
+    answer_callback: Optional[Callable[[str], None]] = None
 ) -> str:
     """Tool: Analyze query results and extract relevant information."""
     try:
-        results = json.loads(results_json)
+        results = orjson.loads(results_json)
         
         if results.get("status") == "empty":
             return "I couldn't find any transactions matching your criteria. Please try adjusting your search filters or date range."
@@ -681,159 +1101,53 @@ def tool_analyze_results(
         if not rows:
             return "I couldn't find any transaction data to analyze. Please try adjusting your search criteria."
         
-        # Use LLM to analyze results
-        llm = ChatGroq(
-            groq_api_key=api_key,
-            model_name="llama-3.3-70b-versatile",
-            temperature=0.3
-        )
+        # Obvious record-list questions skip the LLM entirely; otherwise the analysis call
+        # also classifies the question (RECORDS vs SUMMARY) in the same round trip
+        is_record_list_question = bool(_RECORD_LIST_QUESTION_RE.search(question))
+        analysis = None
         
-        # Use LLM to detect if question is asking for records/list vs summary
-        try:
-            detection_llm = ChatGroq(
-                groq_api_key=api_key,
-                model_name="llama-3.3-70b-versatile",
-                temperature=0.1
+        if not is_record_list_question:
+            analysis, is_record_list_question = _analyze_summary(
+                question, rows, results.get("count", len(rows)), api_key, calculation_result, chat_history,
+                answer_callback
             )
-            
-            detection_prompt = ChatPromptTemplate.from_messages([
-                ("system", "You are a question classifier. Determine if a question is asking to SHOW/LIST/DISPLAY transaction records or asking for a SUMMARY/TOTAL/CALCULATION."),
-                ("human", """Classify the following question:
-
-                Question: {question}
-
-                Determine if this question is asking to:
-                - SHOW/LIST/DISPLAY transaction records (e.g., "show me transactions", "list all transactions", "display my purchases")
-                - OR asking for a SUMMARY/TOTAL/CALCULATION (e.g., "how much", "total spending", "what's my balance")
-
-                Respond with ONLY one word: either "RECORDS" or "SUMMARY".
-                """)
-            ])
-            
-            detection_chain = detection_prompt | detection_llm
-            detection_response = detection_chain.invoke({"question": question})
-            detection_result = detection_response.content.strip().upper()
-            
-            is_record_list_question = "RECORD" in detection_result
-        except Exception as e:
-            # On error, default to summary
-            is_record_list_question = False
         
         # For record-list questions, convert directly to CSV format
         if is_record_list_question:
-            # Get preview rows (first 100) for display
-            preview_rows = rows[:100]
             total_count = results.get("count", len(rows))
             
-            # Try to get ALL rows for CSV download if SQL query is provided
-            all_rows_for_csv = preview_rows  # Default to preview rows
-            if sql_query and db_connection_getter and total_count > len(preview_rows):
-                try:
-                    # Re-execute query to get ALL rows for CSV
-                    conn = db_connection_getter()
-                    df_all = pd.read_sql_query(sql_query, conn)
-                    conn.close()
-                    all_rows_for_csv = df_all.to_dict('records')
-                except Exception as e:
-                    # If re-execution fails, use preview rows
-                    all_rows_for_csv = preview_rows
-            
-            # Convert to DataFrame and generate CSV strings
+            # Generate the CSV straight from the rows (no DataFrame round trip); the UI
+            # previews its first rows, so no separate preview CSV is built
             try:
-                # Preview DataFrame (first 100 rows)
-                df_preview = pd.DataFrame(preview_rows)
-                csv_preview = df_preview.to_csv(index=False)
-                
-                # Full DataFrame (all rows)
-                df_full = pd.DataFrame(all_rows_for_csv)
-                csv_full = df_full.to_csv(index=False)
+                # Full CSV: re-execute the query to stream ALL rows if SQL query is provided,
+                # re-scoped to the selected bank/account IDs like any executed query
+                csv_full = None
+                if sql_query and db_connection_getter and bank_ids and account_ids and total_count > len(rows):
+                    try:
+                        # Rows stream from the cursor into the CSV writer one at a time; the
+                        # cursor (not the shared connection) is closed even if writing fails
+                        conn = db_connection_getter()
+                        export_query = apply_id_filters(sql_query, bank_ids, account_ids)
+                        with closing(conn.execute(export_query)) as cursor:
+                            csv_full = rows_to_csv([col[0] for col in cursor.description], cursor)
+                    except Exception as e:
+                        # If re-execution fails, use the fetched rows
+                        csv_full = None
+                if csv_full is None:
+                    columns = list(rows[0].keys()) if rows else []
+                    csv_full = rows_to_csv(columns, (row.values() for row in rows))
                 
                 # Return CSV with special marker prefix
                 intro_text = f"Found {total_count} transaction(s). Here is your CSV file:"
                 
-                return f"CSV_DATA:{intro_text}\nCSV_PREVIEW:\n{csv_preview}\nCSV_FULL:\n{csv_full}"
+                return f"CSV_DATA:{intro_text}\nCSV_FULL:\n{csv_full}"
                 
             except Exception as csv_error:
                 # If CSV conversion fails, return error message
                 return f"ERROR: Failed to generate CSV file: {str(csv_error)}"
-        else:
-            # Limit to 20 rows for summary questions
-            data_rows = rows[:20]
         
-        # For summary questions, continue with LLM analysis
-        sample_rows = json.dumps(data_rows, default=str)
-        
-        # Build prompt with optional calculation result
-        calculation_context = ""
-        if calculation_result and not calculation_result.startswith("ERROR"):
-            clean_calc_result = " ".join(calculation_result.split()).strip()
-            calculation_context = f"\n\nAdditional Information: The calculation result is {clean_calc_result}. Use this value naturally in your answer."
-        
-        prompt_text = f"""Analyze these query results and answer the user's question.
-
-                Question: {{question}}
-
-                Results (JSON):
-                {{sample_rows}}
-
-                Total rows: {{count}}
-                
-                {calculation_context}
-
-                Instructions:
-                - Answer only what was asked, nothing more
-                - Be brief and direct
-                - Format currency amounts with dollar signs and proper commas (e.g., $1,234.56)
-                - Do not explain the data or provide context
-                - Do not add summaries or interpretations beyond what's directly in the results
-                - Keep responses minimal and factual
-                - Write in plain text with normal spacing - do not remove spaces between words
-                - Remove negative sign from amounts
-                
-                Examples:
-                Example 1 (Summary):
-                Question: How much did I spend last week?
-                Response: You spent $1,234.56 last week.
-
-                Example 2 (Calculation):
-                Question: Compare my last month spending with this month?
-                Response: You spent $234.56 more this month than last month.
-
-                Now generate the appropriate response:
-                """
-        
-        # Build messages with chat history
-        messages = []
-        
-        # Add system message
-        messages.append(("system", "You are a data analyst. Analyze query results and provide insights. Provide natural language summaries for calculation questions."))
-        
-        # Add chat history if available
+        # Store the LLM's answer in chat_history
         if chat_history:
-            history_messages = chat_history.messages[-10:]  # Last 10 messages (5 exchanges)
-            for msg in history_messages:
-                if isinstance(msg, HumanMessage):
-                    messages.append(("human", msg.content))
-                elif isinstance(msg, AIMessage):
-                    messages.append(("assistant", msg.content))
-        
-        # Add current prompt
-        messages.append(("human", prompt_text))
-        
-        prompt_template = ChatPromptTemplate.from_messages(messages)
-        
-        chain = prompt_template | llm
-        response = chain.invoke({
-            "question": question,
-            "sample_rows": sample_rows,
-            "count": results.get("count", len(rows))
-        })
-        
-        analysis = response.content.strip()  # Raw LLM output
-        
-        # Store raw LLM output in chat_history
-        if chat_history and not is_record_list_question:
-            # Add raw LLM analysis output - this is the LLM's direct response
             chat_history.add_ai_message(analysis)
         
         if execution_log_callback:
@@ -841,7 +1155,7 @@ def tool_analyze_results(
                 "step": "analyze_results",
                 "input": f"{results.get('count', 0)} rows",
                 "output": analysis[:200] + "...",
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         
         return analysis
@@ -852,24 +1166,48 @@ def tool_analyze_results(
                 "step": "analyze_results",
                 "input": results_json[:100] + "...",
                 "output": error_msg,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         return error_msg
 
 
+def format_calculation_result(value: float) -> str:
+    """Render a computed number for the analysis step, keeping its precision (ratios can be small)."""
+    # 12 significant digits drop float noise such as 1234.5600000000001 without rounding 0.0345
+    return str(value) if isinstance(value, int) else format(value, ".12g")
+
+def _single_numeric_value(results_json: str) -> Optional[float]:
+    """Return the value of a one-row, one-column numeric query result, else None."""
+    results = orjson.loads(results_json)
+    rows = results.get("rows") or []
+    if len(rows) != 1 or len(rows[0]) != 1:
+        return None
+    value = next(iter(rows[0].values()))
+    return value if type(value) in (int, float) else None
+
 def tool_calculate(
     calculation_request: str, 
     api_key: str,
-    execution_log_callback: Optional[Callable] = None
+    execution_log_callback: Optional[Callable] = None,
+    calculation_cache: Optional[OrderedDict] = None
 ) -> str:
     """Tool: Perform calculations on numeric results."""
+    # Check cache first (identical request text gives the same prompt)
+    cache_key = ("calculate", ' '.join(calculation_request.split()))
+    cached_result = get_from_cache(cache_key, calculation_cache)
+    if cached_result:
+        if execution_log_callback:
+            execution_log_callback({
+                "step": "calculate",
+                "input": calculation_request,
+                "output": f"[CACHED] {cached_result}",
+                "timestamp_ns": time.time_ns()
+            })
+        return cached_result
+    
     try:
         # Simple calculation handler - can be enhanced
-        llm = ChatGroq(
-            groq_api_key=api_key,
-            model_name="llama-3.3-70b-versatile",
-            temperature=0.1
-        )
+        llm = get_llm(api_key, model_name=CALCULATION_MODEL_NAME)
         
         prompt_template = ChatPromptTemplate.from_messages([
             ("system", "You are a calculator. Perform mathematical calculations accurately."),
@@ -890,9 +1228,12 @@ def tool_calculate(
                 "step": "calculate",
                 "input": calculation_request,
                 "output": result,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         
+        # Store in cache
+        set_cache(cache_key, result, calculation_cache)
+        
         return result
     except Exception as e:
         error_msg = f"ERROR: {str(e)}"
@@ -901,12 +1242,22 @@ def tool_calculate(
                 "step": "calculate",
                 "input": calculation_request,
                 "output": error_msg,
-                "timestamp": datetime.now().isoformat()
+                "timestamp_ns": time.time_ns()
             })
         return error_msg
 
 # ==================== AGENT ORCHESTRATOR ====================
 
+# Words (matched as whole tokens) and phrases that indicate a calculation question
+CALCULATION_KEYWORDS = frozenset({
+    "percentage", "percent", "%", "average", "avg", "mean", 
+    "ratio", "difference", "calculate",
+    "compare", "comparison", "increase", "decrease", "change",
+    "growth", "trend", "per", "rate"
+})
+CALCULATION_PHRASES = ("more than", "less than")
+_CALCULATION_TOKEN_RE = re.compile(r'\w+|%')
+
 class TransactionQueryAgent:
     """Agentic AI orchestrator for transaction queries."""
     
@@ -920,9 +1271,11 @@ class TransactionQueryAgent:
         db_connection_getter: Optional[Callable] = None,
         chat_history: Optional[InMemoryChatMessageHistory] = None,
         execution_log_callback: Optional[Callable] = None,
-        sql_cache: Optional[Dict[str, str]] = None,
-        query_result_cache: Optional[Dict[str, str]] = None,
-        analysis_cache: Optional[Dict[str, str]] = None
+        sql_cache: Optional[OrderedDict] = None,
+        query_result_cache: Optional[OrderedDict] = None,
+        analysis_cache: Optional[OrderedDict] = None,
+        validation_cache: Optional[OrderedDict] = None,
+        calculation_cache: Optional[OrderedDict] = None
     ):
         """
         Initialize the TransactionQueryAgent.
@@ -933,7 +1286,7 @@ class TransactionQueryAgent:
             account_ids: List of account IDs for filtering queries (REQUIRED - must contain at least one ID)
             current_date: Current date reference in 'YYYY-MM-DD' format (defaults to None, which uses 'now')
             schema_getter: Function to get database schema
-            db_connection_getter: Function to get database connection
+            db_connection_getter: Function returning a shared database connection (callers must not close it)
             chat_history: Optional InMemoryChatMessageHistory for maintaining conversation context
             execution_log_callback: Optional callback for logging execution steps
         """
@@ -954,6 +1307,8 @@ class TransactionQueryAgent:
         self.sql_cache = sql_cache
         self.query_result_cache = query_result_cache
         self.analysis_cache = analysis_cache
+        self.validation_cache = validation_cache
+        self.calculation_cache = calculation_cache
         self.max_retries = 3
         
         # Get schema if getter provided
@@ -962,6 +1317,31 @@ class TransactionQueryAgent:
         else:
             self.schema = ""
     
+    def update_context(
+        self,
+        bank_ids: Optional[List[int]] = None,
+        account_ids: Optional[List[int]] = None,
+        current_date: Optional[str] = None
+    ):
+        """
+        Update the query filters in place so a cached agent can be reused.
+        
+        Args:
+            bank_ids: New list of bank IDs (unchanged if None)
+            account_ids: New list of account IDs (unchanged if None)
+            current_date: New current date in 'YYYY-MM-DD' format (unchanged if None)
+        """
+        if bank_ids is not None:
+            if len(bank_ids) == 0:
+                raise ValueError("bank_ids is required and must contain at least one ID")
+            self.bank_ids = bank_ids
+        if account_ids is not None:
+            if len(account_ids) == 0:
+                raise ValueError("account_ids is required and must contain at least one ID")
+            self.account_ids = account_ids
+        if current_date is not None:
+            self.current_date = current_date
+    
     def create_tools(self) -> List:
         """Create tools for the agent."""
         if StructuredTool is None:
@@ -1009,28 +1389,122 @@ class TransactionQueryAgent:
     
     def _needs_calculation(self, question: str) -> bool:
         """Check if question requires mathematical calculation."""
-        calculation_keywords = [
-            "percentage", "percent", "%", "average", "avg", "mean", 
-            "ratio", "difference", "more than", "less than", "calculate",
-            "compare", "comparison", "increase", "decrease", "change",
-            "growth", "trend", "per", "rate"
-        ]
         question_lower = question.lower()
-        return any(keyword in question_lower for keyword in calculation_keywords)
+        tokens = set(_CALCULATION_TOKEN_RE.findall(question_lower))
+        if not tokens.isdisjoint(CALCULATION_KEYWORDS):
+            return True
+        return any(phrase in question_lower for phrase in CALCULATION_PHRASES)
+    
+    def _validate_and_generate_sql(self, question: str) -> Tuple[str, str]:
+        """
+        Run question validation and SQL generation concurrently.
+        
+        Both LLM calls run in worker threads; their log entries are buffered and the
+        SQL step's chat history is written to a copy, so the execution log and
+        chat_history are only touched here on the calling thread. The SQL step's log
+        entries and history are discarded when the question is rejected.
+        
+        When the verdict is already cached it is read first, so known-invalid questions
+        never generate SQL and valid ones skip the thread pool.
+        
+        Returns:
+            Tuple of (validation_result_json, sql_result)
+        """
+        if get_from_cache(get_validation_cache_key(question), self.validation_cache) is not None:
+            validation_result = tool_validate_question_context(
+                question, self.api_key, self.execution_log_callback, self.validation_cache
+            )
+            if not orjson.loads(validation_result).get("valid", True):
+                return validation_result, ""
+            # Record the question as the orchestrator path does; a SQL cache hit in
+            # tool_generate_sql returns before touching chat_history
+            if self.chat_history is not None and (
+                not self.chat_history.messages or not isinstance(self.chat_history.messages[-1], HumanMessage)
+            ):
+                self.chat_history.add_user_message(question)
+            sql_result = tool_generate_sql(
+                question,
+                self.schema,
+                self.api_key,
+                self.bank_ids,
+                self.account_ids,
+                self.current_date,
+                self.chat_history,
+                self.execution_log_callback,
+                self.sql_cache
+            )
+            return validation_result, sql_result
+        
+        validation_log: List[Dict] = []
+        sql_log: List[Dict] = []
+        
+        # Speculative history: the current question is added as the orchestrator would
+        history_copy = None
+        if self.chat_history:
+            if isinstance(self.chat_history, BoundedChatMessageHistory):
+                history_copy = self.chat_history.fork()
+            else:
+                history_copy = InMemoryChatMessageHistory(messages=list(self.chat_history.messages))
+            if not history_copy.messages or not isinstance(history_copy.messages[-1], HumanMessage):
+                history_copy.add_user_message(question)
+        
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            validation_future = executor.submit(
+                tool_validate_question_context,
+                question,
+                self.api_key,
+                validation_log.append,
+                self.validation_cache
+            )
+            sql_future = executor.submit(
+                tool_generate_sql,
+                question,
+                self.schema,
+                self.api_key,
+                self.bank_ids,
+                self.account_ids,
+                self.current_date,
+                history_copy,
+                sql_log.append,
+                self.sql_cache
+            )
+            validation_result = validation_future.result()
+            sql_result = sql_future.result()
+        
+        try:
+            is_valid = orjson.loads(validation_result).get("valid", True)
+        except json.JSONDecodeError:
+            is_valid = True
+        
+        entries = validation_log + sql_log if is_valid else validation_log
+        if self.execution_log_callback:
+            for entry in entries:
+                self.execution_log_callback(entry)
+        
+        if is_valid and history_copy is not None:
+            self.chat_history.add_messages(history_copy.messages[len(self.chat_history.messages):])
+        
+        return validation_result, sql_result
     
-    def process_question(self, question: str, context: List[Dict] = None) -> Dict[str, Any]:
-        """Process a question using agentic AI with manual tool orchestration."""        
+    def process_question(
+        self,
+        question: str,
+        context: List[Dict] = None,
+        answer_callback: Optional[Callable[[str], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        Process a question using agentic AI with manual tool orchestration.
+        
+        answer_callback, if given, receives the summary answer text as it streams from
+        the analysis step (called on the calling thread).
+        """
         # Ensure schema is available
         if not self.schema and self.schema_getter:
             self.schema = self.schema_getter()
         
         try:
             # Initialize LLM
-            llm = ChatGroq(
-                groq_api_key=self.api_key,
-                model_name="llama-3.3-70b-versatile",
-                temperature=0.2
-            )
+            llm = get_llm(self.api_key, temperature=0.2)
             
             # Build context
             context_str = ""
@@ -1043,6 +1517,7 @@ class TransactionQueryAgent:
             max_iterations = 5
             iteration = 0
             current_sql = None
+            exec_result = None
             last_error = None
             intermediate_steps = []
             
@@ -1050,20 +1525,16 @@ class TransactionQueryAgent:
                 iteration += 1
                 
                 if iteration == 1:
-                    # Step 0: Validate question context
+                    # Step 0 + 1: Validate question context while speculatively generating SQL
                     thought = "I need to validate if this question is related to bank transactions."
                     action = "validate_question_context"
                     action_input = question
                     
-                    validation_result = tool_validate_question_context(
-                        question,
-                        self.api_key,
-                        self.execution_log_callback
-                    )
+                    validation_result, sql_result = self._validate_and_generate_sql(question)
                     
                     # Parse validation result
                     try:
-                        validation_data = json.loads(validation_result)
+                        validation_data = orjson.loads(validation_result)
                         is_valid = validation_data.get("valid", True)
                         error_message = validation_data.get("error")
                         
@@ -1091,28 +1562,11 @@ class TransactionQueryAgent:
                         "result": "Valid: Question is transaction-related"
                     })
                     
-                    # Store user question in chat_history at the start
-                    if self.chat_history and iteration == 1:
-                        # Check if already added
-                        if not self.chat_history.messages or not isinstance(self.chat_history.messages[-1], HumanMessage):
-                            self.chat_history.add_user_message(question)
-                    
-                    # Step 1: Generate SQL query
+                    # Step 1: Generate SQL query (already produced alongside validation)
                     thought = "I need to generate a SQL query to answer this question."
                     action = "generate_sql"
                     action_input = question
                     
-                    sql_result = tool_generate_sql(
-                        question, 
-                        self.schema, 
-                        self.api_key,
-                        self.bank_ids,
-                        self.account_ids,
-                        self.current_date,
-                        self.chat_history,
-                        self.execution_log_callback,
-                        self.sql_cache
-                    )
                     if sql_result.startswith("ERROR"):
                         return {
                             "success": False, 
@@ -1134,14 +1588,16 @@ class TransactionQueryAgent:
                 action = "execute_query"
                 action_input = current_sql
                 
-                exec_result = tool_execute_query(
-                    current_sql, 
-                    self.bank_ids,
-                    self.account_ids,
-                    self.db_connection_getter,
-                    self.execution_log_callback,
-                    self.query_result_cache
-                )
+                # A refine step may already have executed the current query
+                if exec_result is None:
+                    exec_result = tool_execute_query(
+                        current_sql, 
+                        self.bank_ids,
+                        self.account_ids,
+                        self.db_connection_getter,
+                        self.execution_log_callback,
+                        self.query_result_cache
+                    )
                 
                 if exec_result.startswith("ERROR"):
                     # Step 2a: Refine query if it failed
@@ -1149,7 +1605,9 @@ class TransactionQueryAgent:
                     thought = f"The query failed with error: {exec_result}. I need to refine it."
                     action = "refine_query"
                     
-                    refined_sql = tool_refine_query(
+                    # One LLM call proposes several fixes; they run in order of likelihood
+                    # and the first that executes is kept
+                    candidates, refine_error = tool_refine_query_candidates(
                         current_sql,
                         exec_result,
                         question,
@@ -1158,19 +1616,31 @@ class TransactionQueryAgent:
                         self.execution_log_callback
                     )
                     
-                    if refined_sql.startswith("ERROR"):
+                    if not candidates:
                         return {
                             "success": False, 
-                            "error": f"Could not refine query: {refined_sql}",
+                            "error": f"Could not refine query: {refine_error}",
                             "intermediate_steps": intermediate_steps,
                             "sql_used": current_sql
                         }
                     
+                    for refined_sql in candidates:
+                        exec_result = tool_execute_query(
+                            refined_sql,
+                            self.bank_ids,
+                            self.account_ids,
+                            self.db_connection_getter,
+                            self.execution_log_callback,
+                            self.query_result_cache
+                        )
+                        if not exec_result.startswith("ERROR"):
+                            break
+                    
                     current_sql = refined_sql
                     intermediate_steps.append({
                         "thought": thought,
                         "action": action,
-                        "input": f"Error: {exec_result[:100]}...",
+                        "input": f"Error: {last_error[:100]}...",
                         "result": refined_sql[:100] + "..."
                     })
                     continue
@@ -1179,7 +1649,18 @@ class TransactionQueryAgent:
                 exec_result_json = exec_result
                 calculation_result = None
                 
-                if self._needs_calculation(question):
+                needs_calculation = self._needs_calculation(question)
+                scalar_result = _single_numeric_value(exec_result_json) if needs_calculation else None
+                if scalar_result is not None:
+                    # The query already computed the figure (e.g. an AVG or a ratio); no LLM needed
+                    calculation_result = format_calculation_result(scalar_result)
+                    intermediate_steps.append({
+                        "thought": "The query already returned the calculated value.",
+                        "action": "calculate",
+                        "input": current_sql[:150] + "...",
+                        "result": calculation_result
+                    })
+                elif needs_calculation:
                     thought = "The question requires a mathematical calculation. I'll perform it now."
                     action = "calculate"
                     
@@ -1195,7 +1676,8 @@ class TransactionQueryAgent:
                     calc_result = tool_calculate(
                         calc_request,
                         self.api_key,
-                        self.execution_log_callback
+                        self.execution_log_callback,
+                        self.calculation_cache
                     )
                     
                     if not calc_result.startswith("ERROR"):
@@ -1230,7 +1712,8 @@ class TransactionQueryAgent:
                     sql_query=current_sql,
                     db_connection_getter=self.db_connection_getter,
                     bank_ids=self.bank_ids,
-                    account_ids=self.account_ids
+                    account_ids=self.account_ids,
+                    answer_callback=answer_callback
                 )
                 
                 intermediate_steps.append({
@@ -0,0 +1,130 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.language_models import FakeListChatModel
+
+import scripts.utils as utils
+from scripts.utils import _RECORD_LIST_QUESTION_RE, _analyze_summary, apply_id_filters, rewrite_id_filters
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE TABLE transactions (bank_id INTEGER, account_id INTEGER, amount REAL, "
+        "description TEXT, merchant TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO transactions VALUES (?, ?, ?, ?, ?)",
+        [
+            (1, 1, -10.0, "coffee", "Starbucks"),
+            (1, 2, -20.0, "order by phone", "Pizza"),
+            (2, 3, -30.0, "other user", "Starbucks"),
+            (3, 5, -40.0, "other user order by", "Walmart"),
+        ],
+    )
+    yield conn
+    conn.close()
+
+
+def run(conn, query, bank_ids=(1,), account_ids=(1, 2)):
+    return sorted(conn.execute(apply_id_filters(query, list(bank_ids), list(account_ids))).fetchall())
+
+
+def test_rewrites_equality_and_bare_in_filters():
+    sql = "SELECT * FROM transactions WHERE bank_id = 3 AND account_id IN 5, 6"
+    assert rewrite_id_filters(sql, [1], [1, 2]) == (
+        "SELECT * FROM transactions WHERE bank_id IN (1) AND account_id IN (1,2)"
+    )
+
+
+def test_or_condition_cannot_leak_other_accounts(conn):
+    rows = run(
+        conn,
+        "SELECT bank_id, account_id FROM transactions "
+        "WHERE bank_id = 3 AND account_id IN (5,6) OR merchant LIKE '%Star%'",
+    )
+    assert rows == [(1, 1), (1, 2)]
+
+
+def test_every_union_branch_is_filtered(conn):
+    rows = run(
+        conn,
+        "SELECT account_id FROM transactions WHERE amount < -15 "
+        "UNION SELECT account_id FROM transactions WHERE merchant = 'Starbucks'",
+    )
+    assert rows == [(1,), (2,)]
+
+
+def test_keywords_inside_literals_are_untouched(conn):
+    query = "SELECT description FROM transactions WHERE description LIKE '%order by%' ORDER BY amount LIMIT 5"
+    filtered = apply_id_filters(query, [1], [1, 2])
+    assert "'%order by%'" in filtered
+    assert sorted(conn.execute(filtered).fetchall()) == [("order by phone",)]
+
+
+def test_filters_inside_literals_are_untouched():
+    sql = "SELECT * FROM transactions WHERE description = 'bank_id = 3'"
+    assert rewrite_id_filters(sql, [1], [1]) == sql
+
+
+def test_aggregates_with_trailing_clauses(conn):
+    rows = run(
+        conn,
+        "SELECT merchant, SUM(amount) FROM transactions GROUP BY merchant ORDER BY 2 LIMIT 10;",
+    )
+    assert rows == [("Pizza", -20.0), ("Starbucks", -10.0)]
+
+
+def test_schema_qualified_table_is_still_filtered(conn):
+    assert run(conn, "SELECT COUNT(*) FROM main.transactions") == [(2,)]
+
+
+def test_reapplying_replaces_the_previous_scope(conn):
+    once = apply_id_filters("SELECT COUNT(*) FROM transactions", [1], [1, 2])
+    twice = apply_id_filters(once, [2], [3])
+    assert twice.count("WITH transactions AS") == 1
+    assert conn.execute(twice).fetchall() == [(1,)]
+
+
+@pytest.mark.parametrize("question", [
+    "show me all my transactions",
+    "List my transactions from last week",
+    "display transactions at Walmart",
+])
+def test_record_list_regex_matches_plain_listing(question):
+    assert _RECORD_LIST_QUESTION_RE.search(question)
+
+
+@pytest.mark.parametrize("question", [
+    "give me a summary of my transactions",
+    "show my spending on grocery transactions",
+    "show me my top transactions",
+    "list my biggest purchases",
+    "show me a breakdown of transactions by category",
+])
+def test_record_list_regex_leaves_aggregates_to_llm(question):
+    assert not _RECORD_LIST_QUESTION_RE.search(question)
+
+
+def fake_llm(monkeypatch, responses):
+    model = FakeListChatModel(responses=responses)
+    monkeypatch.setattr(utils, "get_llm", lambda *args, **kwargs: model)
+
+
+def test_analyze_summary_parses_combined_output(monkeypatch):
+    fake_llm(monkeypatch, ['{"mode": "SUMMARY", "answer": "You spent $10.00."}'])
+    assert _analyze_summary("How much?", [{"amount": -10}], 1, "key") == ("You spent $10.00.", False)
+
+
+def test_analyze_summary_falls_back_to_separate_calls(monkeypatch):
+    fake_llm(monkeypatch, ["Sure! Here you go", "SUMMARY", "You spent $10.00."])
+    assert _analyze_summary("How much?", [{"amount": -10}], 1, "key") == ("You spent $10.00.", False)
+
+    fake_llm(monkeypatch, ["not json", "RECORDS"])
+    assert _analyze_summary("Which ones?", [{"amount": -10}], 1, "key") == (None, True)